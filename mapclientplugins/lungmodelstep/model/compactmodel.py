@@ -0,0 +1,133 @@
+import json
+import os
+
+import numpy as np
+
+from mapclientplugins.lungmodelstep.morphic.mesher import Mesh
+from mapclientplugins.lungmodelstep.model.pcabasis import PCABasis
+
+
+class CompactPCAModel(object):
+    """
+    Compact, memory-mappable on-disk format for PCA lung models.
+
+    A model is a directory holding a small JSON header with the node and
+    element topology, and flat .npy arrays for the mean vector, the mode
+    matrix, the mode standard deviations and the integer topology tables.
+    The arrays are opened with numpy memory maps, so opening a model is
+    near instant and processes opening the same model share its pages.
+    """
+
+    formatVersion = 1
+    headerFileName = 'header.json'
+
+    def __init__(self, path):
+        with open(os.path.join(path, self.headerFileName)) as f:
+            self._header = json.load(f)
+        if self._header.get('format') != 'pcamodel' or self._header.get('version') != self.formatVersion:
+            raise ValueError("Not a compact PCA model: " + path)
+
+        self._path = path
+        self._mean = self._loadArray('mean')
+        self._modes = self._loadArray('modes')
+        self._sigma = self._loadArray('sigma')
+        self._nodeOffsets = self._loadArray('node_offsets')
+        self._elementNodes = self._loadArray('element_nodes')
+        self._elementOffsets = self._loadArray('element_offsets')
+        self._nodeIds = [self._parseId(nodeId) for nodeId in self._header['nodeIds']]
+
+    @classmethod
+    def isCompactModel(cls, path):
+        return os.path.isfile(os.path.join(path, cls.headerFileName))
+
+    @classmethod
+    def convert(cls, sourcePath, destinationPath):
+        """
+        Converts a PCA model saved by morphic (pickle, PyTables or h5py) to
+        the compact format.
+        """
+        mesh = Mesh()
+        mesh.load(sourcePath)
+        cls.save(mesh, destinationPath)
+        return cls(destinationPath)
+
+    @classmethod
+    def save(cls, mesh, path):
+        basis = PCABasis.fromMesh(mesh)
+        nodeIds = basis.getNodeIds()
+        nodeIndex = dict((nodeId, index) for index, nodeId in enumerate(nodeIds))
+
+        elementIds, elementBasis, elementNodes, elementOffsets = list(), list(), list(), [0]
+        for element in mesh.elements:
+            elementIds.append(element.id)
+            elementBasis.append(list(element.basis))
+            elementNodes.extend([nodeIndex[nodeId] for nodeId in element.node_ids])
+            elementOffsets.append(len(elementNodes))
+
+        header = {
+            'format': 'pcamodel',
+            'version': cls.formatVersion,
+            'label': mesh.label,
+            'units': mesh.units,
+            'nodeIds': nodeIds,
+            'nodeShapes': [list(mesh.nodes[nodeId].shape) for nodeId in nodeIds],
+            'elementIds': elementIds,
+            'elementBasis': elementBasis,
+        }
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'mean.npy'), basis.getMean())
+        np.save(os.path.join(path, 'modes.npy'), np.ascontiguousarray(basis.getModes()))
+        np.save(os.path.join(path, 'sigma.npy'), basis.getSigma())
+        np.save(os.path.join(path, 'node_offsets.npy'), np.asarray(basis.getNodeOffsets(), dtype=np.int64))
+        np.save(os.path.join(path, 'element_nodes.npy'), np.asarray(elementNodes, dtype=np.int64))
+        np.save(os.path.join(path, 'element_offsets.npy'), np.asarray(elementOffsets, dtype=np.int64))
+        # The header is written last so a partially written model is never picked up.
+        with open(os.path.join(path, cls.headerFileName), 'w') as f:
+            json.dump(header, f)
+
+    def getBasis(self):
+        """
+        Returns the PCA basis backed by the memory-mapped arrays. Its
+        parameter ids match the node parameters of the mesh from toMesh().
+        """
+        return PCABasis(self._mean, self._modes, self._sigma, parameterIds=np.arange(self._mean.size),
+                        nodeIds=self._nodeIds, nodeOffsets=self._nodeOffsets)
+
+    def toMesh(self):
+        """
+        Builds a flat morphic mesh holding the mean shape, with the nodes in
+        the order of the parameter vector, and a ``weights`` node recording
+        the current mode weights as in the original PCA mesh.
+        """
+        mesh = Mesh(label=self._header.get('label', '/'), units=self._header.get('units', 'm'))
+        for index, nodeId in enumerate(self._nodeIds):
+            values = self._mean[self._nodeOffsets[index]:self._nodeOffsets[index + 1]]
+            mesh.add_stdnode(nodeId, values.reshape(self._header['nodeShapes'][index]), group='pca')
+        weights = np.zeros(self._sigma.size + 1)
+        weights[0] = 1
+        mesh.add_stdnode('weights', weights)
+        for index, elementId in enumerate(self._header['elementIds']):
+            nodes = self._elementNodes[self._elementOffsets[index]:self._elementOffsets[index + 1]]
+            mesh.add_element(self._parseId(elementId), [str(base) for base in self._header['elementBasis'][index]],
+                             [self._nodeIds[node] for node in nodes])
+        mesh.generate(True)
+        return mesh
+
+    def _loadArray(self, name):
+        return np.load(os.path.join(self._path, name + '.npy'), mmap_mode='r')
+
+    @staticmethod
+    def _parseId(uid):
+        if isinstance(uid, int):
+            return uid
+        return str(uid)
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 3:
+        print("usage: compactmodel.py <source model> <destination directory>")
+        sys.exit(1)
+    CompactPCAModel.convert(sys.argv[1], sys.argv[2])
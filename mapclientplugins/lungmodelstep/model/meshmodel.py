@@ -1,9 +1,11 @@
 import os
+import numpy as np
 
 from scaffoldmaker.utils.zinc_utils import *
 
 from opencmiss.zinc.graphics import Graphics
 from opencmiss.zinc.field import Field
+from opencmiss.zinc.node import Node
 from opencmiss.utils.maths import vectorops
 from opencmiss.zinc.status import OK as ZINC_OK
 
@@ -12,6 +14,8 @@ from mapclientplugins.lungmodelstep.fields.nodes import Nodes as LungNodes
 
 class MeshModel(object):
 
+    _valueLabels = (Node.VALUE_LABEL_VALUE, Node.VALUE_LABEL_D_DS1, Node.VALUE_LABEL_D_DS2, Node.VALUE_LABEL_D2_DS1DS2)
+
     def __init__(self, leftregion, rightregion, materialModule):
         self._path = self.getPluginPath()
 
@@ -39,6 +43,9 @@ class MeshModel(object):
         self._generateMesh()
 
         self._nodes = LungNodes()
+        self._nodeTables = {'left': self._createNodeTable('left'), 'right': self._createNodeTable('right')}
+        self._pushedNodes = {'left': None, 'right': None}
+        self._morphTolerance = 0.0
 
     def _getVisibility(self, graphicsName):
         return self._settings[graphicsName]
@@ -242,86 +249,70 @@ class MeshModel(object):
     def applyMorphing(self, nodeArray, lung=None):
         self._setNodeParameter(nodeArray, lung=lung)
 
+    def getMorphTolerance(self):
+        return self._morphTolerance
+
+    def setMorphTolerance(self, tolerance):
+        """
+        Node values and derivatives that moved by no more than tolerance
+        since they were last pushed to Zinc are not pushed again.
+        """
+        self._morphTolerance = tolerance
+
     def _setNodeParameter(self, nodeArray, lung):
-        fieldmodule = self._leftRegion.getFieldmodule() if lung == 'left' else self._rightRegion.getFieldmodule() if 'right' == lung else Exception(
-            "Region invalid!")
-        if lung == 'left' and nodeArray.shape[0] != 99:
-            raise Exception("Lung and node array do not match!")
-        elif lung == 'right' and nodeArray.shape[0] != 126:
+        if lung not in self._nodeTables:
+            raise Exception("Region invalid!")
+        fieldmodule, cache, coordinates, nodeTable = self._nodeTables[lung]
+        if nodeArray.shape[0] != len(nodeTable):
             raise Exception("Lung and node array do not match!")
 
-        nodes = self._getLeftNodeField() if lung == 'left' else self._getRightNodeField()
-        cache = fieldmodule.createFieldcache()
-        coordinates = getOrCreateCoordinateField(fieldmodule)
-        nodeIndex = self._getLeftNodeIndex() if lung == 'left' else self._getRightNodeIndex()
+        pushedNodes = self._pushedNodes[lung]
+        if pushedNodes is None:
+            pushedNodes = self._pushedNodes[lung] = np.array(nodeArray, dtype=np.float64)
+            changed = np.ones((nodeArray.shape[0], len(self._valueLabels)), dtype=bool)
+        else:
+            changed = np.abs(nodeArray - pushedNodes).max(axis=1) > self._morphTolerance
+        nodeIndices, valueIndices = np.nonzero(changed)
+        if nodeIndices.size == 0:
+            return None
+        pushedNodes[nodeIndices, :, valueIndices] = nodeArray[nodeIndices, :, valueIndices]
 
         fieldmodule.beginChange()
-        node_iter = nodes.createNodeiterator()
-        node = node_iter.next()
-
-        for n in range(nodeArray.shape[0]):
-
-            if "." not in nodeIndex[n]:
-                nodeID = int(nodeIndex[n])
-                nodeVersion = 1
-            else:
-                nodeID = int(nodeIndex[n].split('.')[0])
-                nodeVersion = int(nodeIndex[n].split('.')[1])
-
-            if node.getIdentifier() == nodeID:
-                pass
-            else:
-                node = node_iter.next()
-
-            cache.setNode(node)
-            resultList = list()
-            """ setting the node xyz coordinates """
-            rx = coordinates.setNodeParameters(cache, 1, Node.VALUE_LABEL_VALUE, nodeVersion, nodeArray[n, 0, 0])
-            ry = coordinates.setNodeParameters(cache, 2, Node.VALUE_LABEL_VALUE, nodeVersion, nodeArray[n, 1, 0])
-            rz = coordinates.setNodeParameters(cache, 3, Node.VALUE_LABEL_VALUE, nodeVersion, nodeArray[n, 2, 0])
-            """ setting the nodal x derivatives """
-            rxds1 = coordinates.setNodeParameters(cache, 1, Node.VALUE_LABEL_D_DS1, nodeVersion, nodeArray[n, 0, 1])
-            rxds2 = coordinates.setNodeParameters(cache, 1, Node.VALUE_LABEL_D_DS2, nodeVersion, nodeArray[n, 0, 2])
-            rxds12 = coordinates.setNodeParameters(cache, 1, Node.VALUE_LABEL_D2_DS1DS2, nodeVersion,
-                                                   nodeArray[n, 0, 3])
-            """ setting the nodal y derivatives """
-            ryds1 = coordinates.setNodeParameters(cache, 2, Node.VALUE_LABEL_D_DS1, nodeVersion, nodeArray[n, 1, 1])
-            ryds2 = coordinates.setNodeParameters(cache, 2, Node.VALUE_LABEL_D_DS2, nodeVersion, nodeArray[n, 1, 2])
-            ryds12 = coordinates.setNodeParameters(cache, 2, Node.VALUE_LABEL_D2_DS1DS2, nodeVersion,
-                                                   nodeArray[n, 1, 3])
-            """ setting the nodal z derivatives """
-            rzds1 = coordinates.setNodeParameters(cache, 3, Node.VALUE_LABEL_D_DS1, nodeVersion, nodeArray[n, 2, 1])
-            rzds2 = coordinates.setNodeParameters(cache, 3, Node.VALUE_LABEL_D_DS2, nodeVersion, nodeArray[n, 2, 2])
-            rzds12 = coordinates.setNodeParameters(cache, 3, Node.VALUE_LABEL_D2_DS1DS2, nodeVersion,
-                                                   nodeArray[n, 2, 3])
-            resultList.append(rx);
-            resultList.append(ry);
-            resultList.append(rz);
-            resultList.append(rxds1);
-            resultList.append(rxds2);
-            resultList.append(rxds12);
-            resultList.append(ryds1);
-            resultList.append(ryds2);
-            resultList.append(ryds12);
-            resultList.append(rzds1);
-            resultList.append(rzds2);
-            resultList.append(rzds12);
-
-            for result in resultList:
-                if result == ZINC_OK:
-                    pass
-                else:
-                    print("ZINC NOT OK!")
-                    print("NODE: {}".format(nodeID))
-                    break
-
+        currentNode = None
+        for n, valueIndex in zip(nodeIndices, valueIndices):
+            node, nodeVersion = nodeTable[n]
+            if n != currentNode:
+                cache.setNode(node)
+                currentNode = n
+            """ setting all xyz components of a value or derivative in one call """
+            result = coordinates.setNodeParameters(cache, -1, self._valueLabels[valueIndex], nodeVersion,
+                                                   nodeArray[n, :, valueIndex].tolist())
+            if result != ZINC_OK:
+                print("ZINC NOT OK!")
+                print("NODE: {}".format(node.getIdentifier()))
         fieldmodule.endChange()
-        del fieldmodule;
-        del cache;
-        del node;
-        del coordinates
         return None
 
+    def _createNodeTable(self, lung):
+        """
+        Resolves the 'N.V' node indices of a lung to Zinc nodes and versions
+        once, so morphing does not have to parse them or walk a node iterator.
+
+        :param lung: 'left' or 'right'
+        :return: fieldmodule, field cache, coordinates field and (node, version) list
+        """
+        region = self._leftRegion if lung == 'left' else self._rightRegion
+        nodes = self._getLeftNodeField() if lung == 'left' else self._getRightNodeField()
+        nodeIndex = self._getLeftNodeIndex() if lung == 'left' else self._getRightNodeIndex()
+
+        nodeTable = list()
+        for index in nodeIndex:
+            nodeID, _, nodeVersion = index.partition('.')
+            nodeTable.append((nodes.findNodeByIdentifier(int(nodeID)), int(nodeVersion) if nodeVersion else 1))
+
+        fieldmodule = region.getFieldmodule()
+        return fieldmodule, fieldmodule.createFieldcache(), getOrCreateCoordinateField(fieldmodule), nodeTable
+
     def _getLeftNodeField(self):
         fieldmodule = self._leftRegion.getFieldmodule()
         nodes = fieldmodule.findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
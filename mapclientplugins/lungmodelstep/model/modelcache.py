@@ -0,0 +1,178 @@
+import collections
+import os
+import sys
+import threading
+
+import numpy as np
+
+from mapclientplugins.lungmodelstep.morphic.mesher import Mesh
+from mapclientplugins.lungmodelstep.model.compactmodel import CompactPCAModel
+from mapclientplugins.lungmodelstep.model.pcabasis import PCABasis, isMemoryMapped
+
+
+class PCAModelCache(object):
+    """
+    Process-wide cache of loaded PCA models.
+
+    Models are keyed by file path, size and modification time, so an edited
+    file is loaded again. Both morphic mesh files and compact PCA models
+    are supported. The least recently used models are evicted once
+    the cached meshes and arrays exceed the memory budget. Memory-mapped
+    arrays of compact models are not counted against the budget, their
+    pages are shared and reclaimable, but are reported separately. The loaded mesh
+    is shared between all users of an entry and must not be modified, each
+    gets its own read-only view of the compiled PCA basis. The mesh of a
+    compact model is only built when it is first asked for, so opening
+    one just reads the header and maps the arrays.
+    """
+
+    _instance = None
+    _instanceLock = threading.Lock()
+
+    def __init__(self, memoryBudget=512 * 1024 * 1024):
+        self._memoryBudget = memoryBudget
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def getInstance(cls):
+        with cls._instanceLock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def getMemoryBudget(self):
+        return self._memoryBudget
+
+    def setMemoryBudget(self, memoryBudget):
+        with self._lock:
+            self._memoryBudget = memoryBudget
+            self._evict()
+
+    def getMemoryUsage(self):
+        with self._lock:
+            return sum(entry.getMemoryUsage() for entry in self._entries.values())
+
+    def getMappedMemoryUsage(self):
+        with self._lock:
+            return sum(entry.getMappedMemoryUsage() for entry in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def load(self, filePath):
+        """
+        Returns the cached model and a read-only PCA basis for a PCA model
+        file, loading and compiling it only if it is not cached yet. The
+        model's mesh is available from its getMesh().
+        """
+        filePath = os.path.abspath(filePath)
+        compact = CompactPCAModel.isCompactModel(filePath)
+        fileStat = os.stat(os.path.join(filePath, CompactPCAModel.headerFileName) if compact else filePath)
+        key = (filePath, fileStat.st_size, fileStat.st_mtime)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                return entry, entry.getBasis()
+
+        if compact:
+            compactModel = CompactPCAModel(filePath)
+            entry = CachedPCAModel(self, compactModel.getBasis().readOnlyView(), compactModel=compactModel)
+        else:
+            mesh = Mesh()
+            mesh.load(filePath)
+            entry = CachedPCAModel(self, PCABasis.fromMesh(mesh).readOnlyView(), mesh=mesh)
+
+        with self._lock:
+            for staleKey in [k for k in self._entries if k[0] == filePath]:
+                del self._entries[staleKey]
+            self._entries[key] = entry
+            self._evict()
+        return entry, entry.getBasis()
+
+    def _meshLoaded(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        usage = sum(entry.getMemoryUsage() for entry in self._entries.values())
+        while usage > self._memoryBudget and len(self._entries) > 0:
+            _, entry = self._entries.popitem(last=False)
+            usage -= entry.getMemoryUsage()
+
+
+class CachedPCAModel(object):
+    """
+    A PCA model held by the cache: the compiled basis and the morphic mesh,
+    which for compact models is built on first use.
+    """
+
+    def __init__(self, cache, basis, mesh=None, compactModel=None):
+        self._cache = cache
+        self._basis = basis
+        self._compactModel = compactModel
+        self._mesh = None
+        self._meshMemoryUsage = 0
+        self._lock = threading.Lock()
+        if mesh is not None:
+            self._setMesh(mesh)
+
+    def getBasis(self):
+        return self._basis.readOnlyView()
+
+    def hasMesh(self):
+        return self._mesh is not None
+
+    def getMesh(self):
+        """
+        Returns the shared, generated mesh, building it from the compact
+        model the first time.
+        """
+        with self._lock:
+            if self._mesh is None:
+                self._setMesh(self._compactModel.toMesh())
+                built = True
+            else:
+                built = False
+        if built:
+            self._cache._meshLoaded()
+        return self._mesh
+
+    def getMemoryUsage(self):
+        return self._basis.getMemoryUsage() + self._meshMemoryUsage
+
+    def getMappedMemoryUsage(self):
+        return self._basis.getMappedMemoryUsage()
+
+    def _setMesh(self, mesh):
+        mesh.generate()
+        self._meshMemoryUsage = getMeshMemoryUsage(mesh)
+        self._mesh = mesh
+
+
+def getMeshMemoryUsage(mesh):
+    """
+    Estimates the memory held by a morphic mesh: the core arrays plus the
+    node, element and face objects and the containers they own.
+    """
+    usage = _getSizeOf(vars(mesh.core))
+    for objects in (mesh.nodes, mesh.elements, mesh.faces):
+        for item in objects:
+            usage += sys.getsizeof(item) + _getSizeOf(vars(item))
+    return usage
+
+
+def _getSizeOf(value):
+    if isinstance(value, np.ndarray):
+        return 0 if isMemoryMapped(value) else value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_getSizeOf(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_getSizeOf(item) for item in value)
+    if isinstance(value, (int, long, float, str)):
+        return sys.getsizeof(value)
+    # References to other objects, e.g. the owning mesh, are counted there.
+    return 0
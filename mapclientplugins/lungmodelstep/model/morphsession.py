@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class MorphSession(object):
+    """
+    Keeps the reconstructed parameter vector of a PCA basis between morphs.
+
+    When a single mode weight changes the vector is moved along that mode
+    only, which costs O(nParams) instead of a full reconstruction. Any
+    other change, and every ``refreshInterval`` single-mode updates, the
+    vector is rebuilt from scratch so rounding errors cannot accumulate.
+    """
+
+    def __init__(self, basis, refreshInterval=64):
+        self._basis = basis
+        self._refreshInterval = refreshInterval
+        self._weights = None
+        self._parameters = None
+        self._updates = 0
+        self.reset()
+
+    def reset(self):
+        self._weights = np.zeros(self._basis.getNumberOfModes())
+        self._parameters = self._basis.reconstruct()
+        self._updates = 0
+
+    def getWeights(self):
+        return self._weights.copy()
+
+    def getParameters(self):
+        """
+        Returns the current parameter vector. The array is updated in place
+        by later morphs, copy it if it has to be kept.
+        """
+        return self._parameters
+
+    def setMode(self, mode, weight):
+        weights = self._weights.copy()
+        weights[mode] = weight
+        return self.setWeights(weights)
+
+    def setWeights(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.size > self._weights.size:
+            raise ValueError("More mode weights than PCA modes!")
+        newWeights = np.zeros(self._weights.size)
+        newWeights[:weights.size] = weights
+
+        changed = np.flatnonzero(newWeights != self._weights)
+        if changed.size == 1 and self._updates < self._refreshInterval:
+            mode = changed[0]
+            self._basis.addMode(self._parameters, mode, newWeights[mode] - self._weights[mode])
+            self._updates += 1
+        elif changed.size > 0:
+            self._parameters = self._basis.reconstruct(newWeights)
+            self._updates = 0
+        self._weights = newWeights
+        return self._parameters
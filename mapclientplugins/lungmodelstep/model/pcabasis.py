@@ -0,0 +1,163 @@
+import mmap
+
+import numpy as np
+
+
+class PCABasis(object):
+    """
+    Flat, contiguous representation of the PCA nodes of a morphic mesh.
+
+    All PCA node parameters are stacked into one mean vector and one
+    (nParams x nModes) mode matrix so a shape can be reconstructed with
+    a single ``mean + modes . (weights * sigma)`` product instead of
+    walking ``Core.PCAMap`` node by node.
+    """
+
+    def __init__(self, mean, modes, sigma, parameterIds=None, nodeIds=None, nodeOffsets=None):
+        self._mean = np.ascontiguousarray(mean, dtype=np.float64)
+        self._modes = np.ascontiguousarray(modes, dtype=np.float64)
+        self._sigma = np.ascontiguousarray(sigma, dtype=np.float64)
+        if self._modes.shape != (self._mean.size, self._sigma.size):
+            raise ValueError("PCA basis shapes do not match!")
+
+        self._parameterIds = None if parameterIds is None else np.asarray(parameterIds, dtype=np.intp)
+        self._nodeIds = [] if nodeIds is None else list(nodeIds)
+        self._nodeOffsets = np.zeros(1, dtype=np.intp) if nodeOffsets is None else np.asarray(nodeOffsets,
+                                                                                                dtype=np.intp)
+        self._nodeIndex = dict((nodeId, index) for index, nodeId in enumerate(self._nodeIds))
+
+    @classmethod
+    def fromMesh(cls, mesh):
+        """
+        Compiles the PCA nodes of a loaded morphic mesh. The weights and
+        variance nodes are shared by every PCA node; the first weight is
+        the mean term and is always one.
+        """
+        P = mesh.core.P
+        pcaNodes = [node for node in mesh.nodes if node._type == 'pca']
+        if len(pcaNodes) == 0:
+            raise ValueError("Mesh does not contain any PCA nodes!")
+
+        weightIds = np.asarray(pcaNodes[0].weights.cids, dtype=np.intp)
+        varianceIds = np.asarray(pcaNodes[0].variance.cids, dtype=np.intp)
+        numModes = weightIds.size - 1
+
+        parameterIds, nodeIds, nodeOffsets, values = list(), list(), [0], list()
+        for node in pcaNodes:
+            if node.weights is not pcaNodes[0].weights or node.variance is not pcaNodes[0].variance:
+                raise ValueError("PCA nodes do not share weights and variance!")
+            cids = np.asarray(node.cids, dtype=np.intp)
+            values.append(P[np.asarray(node.node.cids, dtype=np.intp)].reshape(cids.size, numModes + 1))
+            parameterIds.append(cids)
+            nodeIds.append(node.id)
+            nodeOffsets.append(nodeOffsets[-1] + cids.size)
+
+        values = np.concatenate(values)
+        variance = P[varianceIds]
+        return cls(values[:, 0] * variance[0], values[:, 1:], variance[1:],
+                   parameterIds=np.concatenate(parameterIds), nodeIds=nodeIds, nodeOffsets=nodeOffsets)
+
+    def readOnlyView(self):
+        """
+        Returns a basis sharing this basis' arrays, marked read-only.
+        """
+        arrays = list()
+        for array in (self._mean, self._modes, self._sigma, self._parameterIds, self._nodeOffsets):
+            if array is not None:
+                array = array.view()
+                array.flags.writeable = False
+            arrays.append(array)
+        mean, modes, sigma, parameterIds, nodeOffsets = arrays
+        return PCABasis(mean, modes, sigma, parameterIds=parameterIds, nodeIds=self._nodeIds, nodeOffsets=nodeOffsets)
+
+    def getMemoryUsage(self):
+        """
+        Returns the bytes held in memory by the basis arrays. Memory-mapped
+        arrays are left out, their pages are shared and can be reclaimed.
+        """
+        return sum(array.nbytes for array in self._getArrays() if not isMemoryMapped(array))
+
+    def getMappedMemoryUsage(self):
+        return sum(array.nbytes for array in self._getArrays() if isMemoryMapped(array))
+
+    def _getArrays(self):
+        return [array for array in (self._mean, self._modes, self._sigma, self._parameterIds) if array is not None]
+
+    def getNumberOfModes(self):
+        return self._sigma.size
+
+    def getNumberOfParameters(self):
+        return self._mean.size
+
+    def getParameterIds(self):
+        return self._parameterIds
+
+    def getNodeIds(self):
+        return list(self._nodeIds)
+
+    def getNodeOffsets(self):
+        return self._nodeOffsets
+
+    def getMean(self):
+        return self._mean
+
+    def getModes(self):
+        return self._modes
+
+    def getSigma(self):
+        return self._sigma
+
+    def getNodeRows(self, nodeIds):
+        """
+        Returns the rows of the reconstructed parameter vector holding the
+        values of the given nodes, in the order given.
+        """
+        rows = [np.arange(self._nodeOffsets[self._nodeIndex[nodeId]], self._nodeOffsets[self._nodeIndex[nodeId] + 1])
+                for nodeId in nodeIds]
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.intp)
+        return np.concatenate(rows)
+
+    def modeScores(self, weights):
+        """
+        Pads the mode weights to the number of modes and scales them by
+        the mode standard deviations. Accepts a single weight vector or
+        an (N x nWeights) array of them.
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.shape[-1] > self._sigma.size:
+            raise ValueError("More mode weights than PCA modes!")
+        scores = np.zeros(weights.shape[:-1] + self._sigma.shape)
+        scores[..., :weights.shape[-1]] = weights
+        return scores * self._sigma
+
+    def reconstruct(self, weights=()):
+        return self._mean + np.dot(self._modes, self.modeScores(weights))
+
+    def addMode(self, parameters, mode, weight):
+        """
+        Moves a reconstructed parameter vector, in place, by ``weight``
+        standard deviations along one mode.
+        """
+        parameters += (weight * self._sigma[mode]) * self._modes[:, mode]
+        return parameters
+
+    def reconstructBatch(self, weights):
+        """
+        Reconstructs N shapes from an (N x nWeights) array of mode weights
+        with one matrix-matrix product. Returns an (N x nParams) array.
+        """
+        weights = np.atleast_2d(weights)
+        return self._mean + np.dot(self.modeScores(weights), self._modes.T)
+
+
+def isMemoryMapped(array):
+    """
+    Returns True if the array's data lives in a memory-mapped file, also
+    for views of such arrays.
+    """
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, 'base', None)
+    return False
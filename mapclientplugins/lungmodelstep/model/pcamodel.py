@@ -1,52 +1,57 @@
 import numpy as np
-from mapclientplugins.lungmodelstep.morphic.mesher import Mesh
 from mapclientplugins.lungmodelstep.fields.nodes import Nodes
 from mapclientplugins.lungmodelstep.fields.elements import Elements
+from mapclientplugins.lungmodelstep.model.modelcache import PCAModelCache
+from mapclientplugins.lungmodelstep.model.morphsession import MorphSession
+from mapclientplugins.lungmodelstep.model.surfacepreview import SurfacePreview
 
 
 class PCAModel(object):
 
     def __init__(self, pcaModelData):
-        self._pcaModel = Mesh()
-        self._pcaModel.load(pcaModelData)
+        self._cachedModel, self._basis = PCAModelCache.getInstance().load(pcaModelData)
 
         self._nodes = Nodes()
         self._elements = Elements()
 
+        self._leftRows = self._basis.getNodeRows(self._getLeftNodeIndex())
+        self._rightRows = self._basis.getNodeRows(self._getRightNodeIndex())
+
     def _getPCAModel(self):
-        return self._pcaModel
+        return self._cachedModel.getMesh()
 
     def averageLung(self):
-        self._pcaModel.nodes['weights'].values[1:] = 0
-        self._pcaModel.nodes['weights'].values[0] = 1
-        self._pcaModel.update_pca_nodes()
-        leftNodes, rightNodes = self._getLeftLungNodes(), self._getRightLungNodes()
-        return leftNodes, rightNodes
+        return self.getLungNodes(self._basis.reconstruct())
 
     def morph(self, weights):
-        self._pcaModel.nodes['weights'].values[1:] = 0
-        self._pcaModel.nodes['weights'].values[0] = 1
-        for modeScore in range(len(weights)):
-            self._pcaModel.nodes['weights'].values[modeScore + 1] = weights[modeScore]
-            self._pcaModel.update_pca_nodes()
-        leftNodes, rightNodes = self._getLeftLungNodes(), self._getRightLungNodes()
+        return self.getLungNodes(self._basis.reconstruct(weights))
+
+    def createMorphSession(self):
+        return MorphSession(self._basis)
+
+    def createSurfacePreview(self, elementGroups=None, resolution=8):
+        return SurfacePreview(self._getPCAModel(), self._basis, elementGroups=elementGroups, resolution=resolution)
+
+    def getLungNodes(self, parameters):
+        """
+        Splits a reconstructed parameter vector, e.g. from a morph session,
+        into the left and right lung node arrays.
+        """
+        leftNodes = parameters[self._leftRows].reshape(-1, 3, 4)
+        rightNodes = parameters[self._rightRows].reshape(-1, 3, 4)
         return leftNodes, rightNodes
 
-    def _getLeftLungNodes(self):
-        nodeValues = list()
-        nodes = self._nodes.setNode(lung='left')
-        for nodeNumber in nodes:
-            node = self._pcaModel.nodes[nodeNumber]
-            nodeValues.append(node.values)
-        return np.asarray(nodeValues, dtype=np.float64)
-
-    def _getRightLungNodes(self):
-        nodeValues = list()
-        nodes = self._nodes.setNode(lung='right')
-        for nodeNumber in nodes:
-            node = self._pcaModel.nodes[nodeNumber]
-            nodeValues.append(node.values)
-        return np.asarray(nodeValues, dtype=np.float64)
+    def morphBatch(self, weights):
+        """
+        Morphs a population of lungs in one go.
+
+        :param weights: (N x nModes) array of mode scores, one row per lung.
+        :return: (N, nodes, 3, 4) node arrays for the left and right lungs.
+        """
+        parameters = self._basis.reconstructBatch(weights)
+        leftNodes = parameters[:, self._leftRows].reshape(parameters.shape[0], -1, 3, 4)
+        rightNodes = parameters[:, self._rightRows].reshape(parameters.shape[0], -1, 3, 4)
+        return leftNodes, rightNodes
 
     def _getLeftNodeIndex(self):
         return self._nodes.setNode(lung='left')
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class SurfacePreview(object):
+    """
+    Linear model of the tessellated lobe surfaces of a PCA lung model.
+
+    Surface points are linear in the node parameters, which are linear in
+    the mode weights, so each lobe surface is stored as a mean point array
+    plus one displacement array per mode. A preview for new weights is then
+    one small matrix product, without reconstructing the nodes or
+    re-interpolating the elements.
+    """
+
+    def __init__(self, mesh, basis, elementGroups=None, resolution=8):
+        """
+        :param mesh: loaded PCA mesh, which is not modified.
+        :param basis: PCABasis compiled from the mesh.
+        :param elementGroups: dict of group name to a list of mesh element
+            ids, None for all elements in a single 'lung' group.
+        :param resolution: number of xi divisions per element.
+        """
+        self._basis = basis
+        self._resolution = resolution
+        self._surfaces = dict()
+        if elementGroups is None:
+            elementGroups = {'lung': None}
+
+        parameterIds = basis.getParameterIds()
+        P = mesh.core.P.copy()
+        for name, elements in elementGroups.items():
+            P[parameterIds] = basis.getMean()
+            X, T = mesh.get_surfaces(res=resolution, elements=elements, params=P)
+            displacements = np.empty((X.size, basis.getNumberOfModes()))
+            for mode in range(basis.getNumberOfModes()):
+                P[parameterIds] = basis.getModes()[:, mode]
+                displacements[:, mode] = mesh.get_surfaces(res=resolution, elements=elements, params=P)[0].ravel()
+            self._surfaces[name] = (X.ravel(), displacements, T)
+
+    def getGroupNames(self):
+        return list(self._surfaces.keys())
+
+    def getResolution(self):
+        return self._resolution
+
+    def getSurface(self, name, weights=()):
+        """
+        Returns the surface points (nPoints x 3) and triangles (nTriangles x 3)
+        of a group for the given mode weights.
+        """
+        mean, displacements, T = self._surfaces[name]
+        X = mean + np.dot(displacements, self._basis.modeScores(weights))
+        return X.reshape(-1, 3), T
@@ -4,6 +4,7 @@ This module manages the low level parameters describing the mesh.
 import interpolator
 import string
 import random
+import collections
 import numpy
 
 
@@ -112,6 +113,7 @@ class ObjectList:
         self._object_ids = {}
         self._id_counter = 0
         self.groups = {}
+        self._group_members = {}
 
     def size(self):
         '''
@@ -162,48 +164,65 @@ class ObjectList:
         self._id_counter = value
 
     def get_unique_id(self, random_chars=0):
-        existing_ids = self._object_ids.keys()
         if random_chars > 0:
-            random_id = existing_ids[0]
-            while random_id in existing_ids:
+            while True:
                 random_id = ''.join(random.choice(string.ascii_letters + string.digits) for x in range(random_chars))
-            return random_id
+                if random_id not in self._object_ids:
+                    return random_id
         else:
-            while True:
-                if self._id_counter in existing_ids:
-                    self._id_counter += 1
-                else:
-                    return self._id_counter
+            while self._id_counter in self._object_ids:
+                self._id_counter += 1
+            return self._id_counter
 
     def add_to_group(self, uids, group):
+        '''
+        Adds objects to a group. Groups keep the order objects were
+        added in; a set of members alongside each group makes the
+        membership test O(1).
+        '''
         if not isinstance(uids, list):
             uids = [uids]
+        if group not in self.groups:
+            self.groups[group] = []
+            self._group_members[group] = set()
+        objs = self.groups[group]
+        members = self._group_members[group]
         for uid in uids:
-            if group not in self.groups.keys():
-                self.groups[group] = []
             obj = self._object_ids[uid]
-            if obj not in self.groups[group]:
-                self.groups[group].append(obj)
+            if obj not in members:
+                members.add(obj)
+                objs.append(obj)
 
     def reset_object_list(self):
         self._objects = []
         self._object_ids = {}
         self._id_counter = 0
         self.groups = {}
+        self._group_members = {}
 
     def _get_group(self, group):
-        if group in self.groups.keys():
+        if group in self.groups:
             return self.groups[group]
         else:
             return []
 
     def get_groups(self, groups):
+        '''
+        Returns the objects in any of the groups, without duplicates, in
+        the order they appear in the groups.
+        '''
         if not isinstance(groups, list):
             groups = [groups]
+        if len(groups) == 1:
+            return list(self._get_group(groups[0]))
         objs = []
+        seen = set()
         for group in groups:
-            objs.extend(self._get_group(group))
-        return [obj for obj in set(objs)]
+            for obj in self._get_group(group):
+                if obj not in seen:
+                    seen.add(obj)
+                    objs.append(obj)
+        return objs
 
     def _save_dict(self):
         objlist_dict = {}
@@ -217,11 +236,12 @@ class ObjectList:
 
     def _load_dict(self, objlist_dict):
         self.groups = {}
+        self._group_members = {}
         for group in objlist_dict['groups'].keys():
             self.add_to_group(objlist_dict['groups'][group], group)
 
     def __contains__(self, item):
-        return item in self._object_ids.keys()
+        return item in self._object_ids
 
     def __getitem__(self, keys):
         if isinstance(keys, list):
@@ -236,15 +256,25 @@ class ObjectList:
         return self._objects.__iter__()
 
 
-class Core():
+class Core(object):
 
     def __init__(self):
-        self.P = numpy.array([])
+        # Parameters are stored in over-allocated buffers which double in
+        # capacity when full, so adding n nodes costs O(n) rather than the
+        # O(n^2) of appending to a new array for every node. P and fixed
+        # are views of the used part of the buffers.
+        self._P = numpy.zeros(0)
+        self._fixed = numpy.zeros(0, dtype=bool)
+        self._num_params = 0
+        self._num_fixed = 0
         self.EFn = []
         self.EMap = []
+        self.EIndex = []
+        self.EIndexTable = None
         self.DNMap = []
         self.PCAMap = []
-        self.fixed = numpy.array([])
+        self._dn_groups = None
+        self._pca_groups = None
         self.idx_unfixed = []
         self.variable_ids = []
 
@@ -264,11 +294,42 @@ class Core():
                                     [0.1803807865240693, 0.1803807865240693, 0.2339569672863455, 0.2339569672863455,
                                      0.0856622461895852, 0.0856622461895852])]
 
+    @property
+    def P(self):
+        return self._P[:self._num_params]
+
+    @P.setter
+    def P(self, P):
+        self._P = numpy.array(P, dtype=float).ravel()
+        self._num_params = self._P.size
+
+    @property
+    def fixed(self):
+        return self._fixed[:self._num_fixed]
+
+    @fixed.setter
+    def fixed(self, fixed):
+        self._fixed = numpy.array(fixed, dtype=bool).ravel()
+        self._num_fixed = self._fixed.size
+
+    def _reserve(self, buf, size):
+        if size <= buf.size:
+            return buf
+        new_buf = numpy.zeros(max(size, 2 * buf.size, 16), dtype=buf.dtype)
+        new_buf[:buf.size] = buf
+        return new_buf
+
     def add_params(self, params):
-        i0 = self.P.size
-        self.P = numpy.append(self.P, params)
-        self.fixed = numpy.append(self.fixed, [False for p in params])
-        return range(i0, self.P.size)
+        params = numpy.asarray(params, dtype=float).ravel()
+        i0, i1 = self._num_params, self._num_params + params.size
+        self._P = self._reserve(self._P, i1)
+        self._P[i0:i1] = params
+        self._num_params = i1
+        j0, j1 = self._num_fixed, self._num_fixed + params.size
+        self._fixed = self._reserve(self._fixed, j1)
+        self._fixed[j0:j1] = False
+        self._num_fixed = j1
+        return range(i0, i1)
 
     def update_params(self, cids, params):
         self.P[cids] = params
@@ -333,12 +394,49 @@ class Core():
     def generate_element_map(self, mesh):
         self.EFn = []
         self.EMap = []
+        self.EIndex = []
         cid = 0
         for elem in mesh.elements:
             self.EFn.append(elem.basis)
             self.EMap.append(elem._get_param_indicies())
+            self.EIndex.append(numpy.array(self.EMap[-1], dtype=int))
             elem.set_core_id(cid)
             cid += 1
+        self._generate_element_index_table()
+
+    def update_element_map(self, elements):
+        '''
+        Remaps the given elements, appending those without a core id, and
+        leaves the maps of all other elements untouched.
+        '''
+        if len(elements) == 0:
+            return
+        for elem in elements:
+            if elem.cid is None:
+                elem.set_core_id(len(self.EFn))
+                self.EFn.append(None)
+                self.EMap.append(None)
+                self.EIndex.append(None)
+            self.EFn[elem.cid] = elem.basis
+            self.EMap[elem.cid] = elem._get_param_indicies()
+            self.EIndex[elem.cid] = numpy.array(self.EMap[elem.cid], dtype=int)
+        self._generate_element_index_table()
+
+    def _generate_element_index_table(self):
+        # Dense (elements x fields x basis functions) gather table, only
+        # available when every element has the same number of parameters.
+        self.EIndexTable = None
+        if len(self.EIndex) > 0 and all(ei.shape == self.EIndex[0].shape for ei in self.EIndex):
+            self.EIndexTable = numpy.array(self.EIndex)
+
+    def element_index(self, cids):
+        '''
+        Returns the (elements x fields x basis functions) indices of the
+        parameters of the elements into P.
+        '''
+        if self.EIndexTable is not None:
+            return self.EIndexTable[cids]
+        return numpy.array([self.EIndex[cid] for cid in cids])
 
     def generate_dependent_node_map(self, mesh):
         self.DNMap = []
@@ -347,74 +445,137 @@ class Core():
                 elem = node.mesh.elements[node.element]
                 pnode = node.mesh.nodes[node.node]
                 self.DNMap.append([elem.cid, pnode.cids, node.cids])
-
-    def update_dependent_nodes(self):
-        # update dependent nodes
-        for dn in self.DNMap:
+        self._compile_dependent_nodes()
+
+    def _compile_dependent_nodes(self):
+        """
+        Groups the dependent nodes by element basis and sizes into index
+        arrays so each group is updated with a few vectorized operations.
+        Dependent nodes on elements using other dependent nodes are put in
+        a later level so chains update in order.
+        """
+        owner = {}
+        for ind, dn in enumerate(self.DNMap):
+            for pid in dn[2]:
+                owner[pid] = ind
+
+        levels = [None] * len(self.DNMap)
+
+        def get_level(ind, visiting):
+            if levels[ind] is None:
+                if ind in visiting:
+                    raise ValueError('Cyclic dependent nodes')
+                visiting.add(ind)
+                cid, xi_cids = self.DNMap[ind][0], self.DNMap[ind][1]
+                deps = set(owner.get(pid) for pid in self.EIndex[cid].ravel())
+                deps.update(owner.get(pid) for pid in xi_cids)
+                deps.discard(None)
+                deps.discard(ind)
+                levels[ind] = 1 + max([get_level(dep, visiting) for dep in deps] + [-1])
+                visiting.discard(ind)
+            return levels[ind]
+
+        groups = collections.OrderedDict()
+        for ind, dn in enumerate(self.DNMap):
             cid = dn[0]
-            xi_cids = dn[1]
-            dn_cids = dn[2]
             num_fields = len(self.EMap[cid])
-            if num_fields == 1:
-                xi = numpy.array([self.P[xi_cids]]).T
-            else:
-                xi = numpy.array([self.P[xi_cids]])
-            Phi = interpolator.weights(self.EFn[cid], xi)
-            for i in range(num_fields):
-                self.P[dn_cids[i]] = numpy.dot(Phi, self.P[self.EMap[cid][i]])
+            key = (get_level(ind, set()), tuple(self.EFn[cid]), self.EIndex[cid].shape, len(dn[1]))
+            group = groups.setdefault(key, ([], [], []))
+            group[0].append(cid)
+            group[1].append(dn[1])
+            group[2].append(dn[2][:num_fields])
+
+        self._dn_groups = []
+        for key in sorted(groups.keys(), key=lambda k: k[0]):
+            cids, xi_cids, dn_cids = groups[key]
+            self._dn_groups.append((list(key[1]), numpy.array(cids, dtype=int),
+                                    numpy.array(xi_cids, dtype=int), numpy.array(dn_cids, dtype=int)))
+
+    def update_dependent_nodes(self):
+        if self._dn_groups is None:
+            self._compile_dependent_nodes()
+        for basis, cids, xi_cids, dn_cids in self._dn_groups:
+            Phi = interpolator.weights(basis, self.P[xi_cids])
+            V = self.P[self.element_index(cids)]
+            self.P[dn_cids] = numpy.einsum('nb,nfb->nf', Phi, V)
 
     def add_pca_node(self, pca_node):
         self.PCAMap.append(
             [pca_node.cids, pca_node.node.shape, pca_node.node.cids, pca_node.weights.cids, pca_node.variance.cids])
+        self._pca_groups = None
         return len(self.PCAMap) - 1
 
-    def update_pca_nodes(self):
+    def _compile_pca_nodes(self):
+        """
+        Groups the PCA nodes sharing weights and variance nodes into one
+        (values x modes) index table per group.
+        """
+        groups = collections.OrderedDict()
         for pcamap in self.PCAMap:
-            # self.P[pcamap[0]] = self.P[pcamap[0]].reshape(3, 4)
-            self.P[pcamap[0]] = numpy.dot(self.P[pcamap[2]].reshape(pcamap[1]),
-                self.P[pcamap[3]] * self.P[pcamap[4]]).reshape(12, )
+            key = (tuple(pcamap[3]), tuple(pcamap[4]))
+            group = groups.setdefault(key, ([], []))
+            num_modes = pcamap[1][-1]
+            group[0].append(numpy.asarray(pcamap[0], dtype=int).ravel())
+            group[1].append(numpy.asarray(pcamap[2], dtype=int).reshape(-1, num_modes))
+
+        self._pca_groups = []
+        for (weights_cids, variance_cids), (cids, mode_cids) in groups.items():
+            self._pca_groups.append((numpy.concatenate(cids), numpy.concatenate(mode_cids),
+                                     numpy.array(weights_cids, dtype=int), numpy.array(variance_cids, dtype=int)))
+
+    def update_pca_nodes(self):
+        if self._pca_groups is None:
+            self._compile_pca_nodes()
+        for cids, mode_cids, weights_cids, variance_cids in self._pca_groups:
+            self.P[cids] = numpy.dot(self.P[mode_cids], self.P[weights_cids] * self.P[variance_cids])
 
     def weights(self, cid, xi, deriv=None):
-        return interpolator.weights(self.EFn[cid], xi, deriv=deriv)
+        return interpolator.cached_weights(self.EFn[cid], xi, deriv=deriv)
 
     def evaluate(self, cid, xi, deriv=None):
-        num_fields = len(self.EMap[cid])
-        # ~ print self.EMap[cid].shape
-        X = numpy.zeros((xi.shape[0], num_fields))
-        Phi = interpolator.weights(self.EFn[cid], xi, deriv=deriv)
-        for i in range(num_fields):
-            X[:, i] = numpy.dot(Phi, self.P[self.EMap[cid][i]])
-        return X
+        Phi = interpolator.cached_weights(self.EFn[cid], xi, deriv=deriv)
+        return numpy.dot(Phi, self.P[self.EIndex[cid]].T)
 
     def evaluates(self, cids, xi, deriv=None, X=None):
-        num_fields = len(self.EMap[cids[0]])
-        if X == None:
-            X = numpy.zeros((len(cids) * xi.shape[0], num_fields))
-        Phi = interpolator.weights(self.EFn[cids[0]], xi, deriv=deriv)
-        Nxi = xi.shape[0]
-        ind = 0
-        for cid in cids:
-            for i in range(num_fields):
-                X[ind:ind + Nxi, i] = numpy.dot(Phi, self.P[self.EMap[cid][i]])
-            ind += Nxi
-        return X
+        Phi = interpolator.cached_weights(self.EFn[cids[0]], xi, deriv=deriv)
+        return self.evaluates_weights(cids, Phi, X=X)
 
     def evaluates_weights(self, cids, Phi, X=None):
-        num_fields = len(self.EMap[cids[0]])
-        if X == None:
-            X = numpy.zeros((len(cids) * Phi.shape[0], num_fields))
-        Nxi = Phi.shape[0]
-        ind = 0
-        for cid in cids:
-            for i in range(num_fields):
-                X[ind:ind + Nxi, i] = numpy.dot(Phi, self.P[self.EMap[cid][i]])
-            ind += Nxi
+        '''
+        Evaluates elements sharing a basis at the points with the basis
+        weights Phi. The element parameters are gathered in one go and
+        evaluated with a single product.
+        '''
+        V = self.P[self.element_index(cids)]
+        Xe = numpy.dot(V, Phi.T).transpose(0, 2, 1).reshape(-1, V.shape[1])
+        if X is None:
+            return Xe
+        X[:] = Xe
         return X
 
+    def evaluate_derivatives(self, cid, xi, order=1):
+        '''
+        Evaluates the element value and all derivatives up to order in one
+        pass. Returns an (nderivs x npoints x nfields) array ordered as
+        interpolator.derivative_orders, e.g., [x, dx/dxi1, dx/dxi2].
+        '''
+        Phi = interpolator.cached_weights_derivatives(self.EFn[cid], xi, order=order)
+        return numpy.dot(Phi, self.P[self.EIndex[cid]].T)
+
+    def evaluates_derivatives(self, cids, xi, order=1):
+        '''
+        Same as evaluate_derivatives for elements sharing a basis. Returns
+        an (nderivs x nelements * npoints x nfields) array.
+        '''
+        Phi = interpolator.cached_weights_derivatives(self.EFn[cids[0]], xi, order=order)
+        V = self.P[self.element_index(cids)]
+        X = numpy.dot(V, Phi.transpose(0, 2, 1))
+        return X.transpose(2, 0, 3, 1).reshape(Phi.shape[0], -1, V.shape[1])
+
     def evaluate_fields(self, cid, xi, fields):
         num_fields = len(fields)
         X = numpy.zeros((xi.shape[0], num_fields))
         for i, field in enumerate(fields):
-            Phi = interpolator.weights(self.EFn[cid], xi, deriv=field[1:])
-            X[:, i] = numpy.dot(Phi, self.P[self.EMap[cid][field[0]]])
+            Phi = interpolator.cached_weights(self.EFn[cid], xi, deriv=field[1:])
+            X[:, i] = numpy.dot(Phi, self.P[self.EIndex[cid][field[0]]])
         return X
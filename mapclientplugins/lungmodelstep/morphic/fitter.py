@@ -160,6 +160,78 @@ class Data:
             return self.values
         
 
+def query_tree(tree, x, k=1, workers=1):
+    '''
+    Queries a cKDTree with a number of worker threads. Older scipy
+    releases call the argument n_jobs.
+    '''
+    if workers == 1:
+        return tree.query(x, k=k)
+    try:
+        return tree.query(x, k=k, workers=workers)
+    except TypeError:
+        return tree.query(x, k=k, n_jobs=workers)
+
+
+class ClosestPointEngine:
+    '''
+    Finds the closest mesh sample point to each data point while the
+    mesh is being optimised, without rebuilding a KD-tree on every call.
+    
+    When the index is built, the ``num_candidates`` nearest samples to
+    each data point are kept. Until the samples next move further than
+    ``delta`` (the largest displacement of any sample since the index
+    was built), a sample that is not a candidate is at least ``d_k -
+    delta`` from the data point, where ``d_k`` is the distance to the
+    furthest candidate. So the closest candidate is exactly the closest
+    sample whenever its distance is no more than that bound. The index
+    is rebuilt only when the bound fails for some data point, which
+    means the results always match a fresh query.
+    '''
+    
+    def __init__(self, Xd, num_candidates=8, workers=1):
+        self.source = Xd
+        self.Xd = scipy.asarray(Xd, dtype=float)
+        self.num_candidates = num_candidates
+        self.workers = workers
+        self.X0 = None
+        self.candidates = None
+        self.bound = None
+        self.num_rebuilds = 0
+    
+    def rebuild(self, X):
+        self.X0 = X.copy()
+        k = min(self.num_candidates, X.shape[0])
+        rr, ii = query_tree(cKDTree(self.X0), self.Xd, k=k,
+                workers=self.workers)
+        if k == 1:
+            rr, ii = rr[:, scipy.newaxis], ii[:, scipy.newaxis]
+        self.candidates = ii
+        if k < X.shape[0]:
+            self.bound = rr[:, -1]
+        else:
+            self.bound = scipy.inf * scipy.ones(rr.shape[0])
+        self.num_rebuilds += 1
+    
+    def query(self, X):
+        '''
+        Returns the distance from each data point to its closest row of
+        X and the index of that row.
+        '''
+        if self.X0 is None or self.X0.shape != X.shape:
+            self.rebuild(X)
+        delta = scipy.sqrt(((X - self.X0) ** 2).sum(1).max())
+        dX = X[self.candidates] - self.Xd[:, scipy.newaxis, :]
+        rr = scipy.sqrt((dX * dX).sum(2))
+        jj = rr.argmin(1)
+        ind = scipy.arange(rr.shape[0])
+        err = rr[ind, jj]
+        if (err > self.bound - delta).any():
+            self.rebuild(X)
+            return self.query(X)
+        return err, self.candidates[ind, jj]
+
+
 class Fit:
     
     def __init__(self, method='data_to_mesh_closest'):
@@ -176,13 +248,29 @@ class Fit:
             'mesh_to_data_closest': self.objfn_mesh_to_data_closest
             }
         
+        self._jacfns = {
+            'd2mc': self.jacfn_data_to_mesh_closest,
+            'm2dc': self.jacfn_mesh_to_data_closest,
+            'data_to_mesh_closest': self.jacfn_data_to_mesh_closest,
+            'mesh_to_data_closest': self.jacfn_mesh_to_data_closest
+            }
+        
+        self.jacfn = None
         if isinstance(method, str):
             self.objfn = self._objfns[method]
+            self.jacfn = self._jacfns.get(method)
         
         self.on_start = None
         self.objective_function = None
+        self.jacobian_function = None
         self.on_stop = None
         
+        # Threads used for KD-tree queries and the number of nearest
+        # samples kept per data point by the closest point engine.
+        self.workers = 1
+        self.num_candidates = 8
+        self._closest = None
+        
         self.X = None
         self.Xi = None
         self.A = None
@@ -193,7 +281,15 @@ class Fit:
         
         
         self.use_sparse = True
+        # Solves the normal equations with a sparse LU factorization
+        # cached until the matrix is regenerated, instead of lsqr. Falls
+        # back to lsqr if the normal equations are singular.
+        self.use_factorization = False
+        self.regularisation = 0.0
+        self._factor = None
+        self._singular = False
         self.param_ids = []
+        self._column_index = {}
         self.num_dof = 0
         self.num_rows = 0
         
@@ -246,7 +342,7 @@ class Fit:
         self.data.reset_object_list()
     
     def get_column_index(self, param_ids):
-        return [self.param_ids.index(pid) for pid in param_ids]
+        return [self._column_index[pid] for pid in param_ids]
     
     def update_from_mesh(self, mesh):
         for point in self.points:
@@ -269,15 +365,17 @@ class Fit:
         self.param_ids = [pid for pid in set(param_ids)]
         self.param_ids.sort()
         self.num_dof = len(self.param_ids)
+        self._column_index = dict((pid, col) for col, pid in enumerate(self.param_ids))
         self.W = scipy.ones(self.num_rows)
         self.data_map = []
+        self._factor = None
+        self._singular = False
+        self.svd_UT, self.svd_S, self.svd_VT = None, None, None
+        self.svd_invA = None
         
-        if self.use_sparse:
-            self.A = scipy.sparse.lil_matrix((self.num_rows, self.num_dof))
-        
-        else:
-            self.A = scipy.zeros((self.num_rows, self.num_dof))
-        
+        # Gathers the entries of all rows and assembles the matrix in one
+        # go, duplicate entries are summed.
+        row_lengths, entry_pids, entry_weights = [], [], []
         row_ind = -1
         for pid, point in enumerate(self.points):
             bind_weight = point.get_bind_weight()
@@ -285,15 +383,28 @@ class Fit:
                 field = point.get_field_id(field_ind)
                 weights = point.get_param_weights(field_ind)
                 param_ids = point.get_param_ids(field_ind)
-                cols = self.get_column_index(param_ids)
                 row_ind += 1
                 self.data_map.append([pid, field])
-                for col, weight in zip(cols, weights):
-                    self.A[row_ind, col] += weight
+                num_entries = min(len(param_ids), len(weights))
+                row_lengths.append(num_entries)
+                entry_pids.extend(param_ids[:num_entries])
+                entry_weights.append(scipy.asarray(weights, dtype=float)[:num_entries])
+                if num_entries > 0:
                     self.W[row_ind] = bind_weight
         
+        rows = scipy.repeat(scipy.arange(len(row_lengths)), row_lengths)
+        cols = scipy.searchsorted(scipy.array(self.param_ids), entry_pids)
+        if len(entry_weights) > 0:
+            weights = scipy.concatenate(entry_weights)
+        else:
+            weights = scipy.zeros(0)
+        
         if self.use_sparse:
-            self.A = self.A.tocsc()
+            self.A = scipy.sparse.coo_matrix((weights, (rows, cols)),
+                    shape=(self.num_rows, self.num_dof)).tocsc()
+        else:
+            self.A = scipy.zeros((self.num_rows, self.num_dof))
+            scipy.add.at(self.A, (rows, cols), weights)
     
     def generate_fast_data(self):
         num_rows = {}
@@ -313,12 +424,88 @@ class Fit:
                     self.data[point.data].add_point(point)
         
         
-    def invert_matrix(self):
+    def invert_matrix(self, rank=None, rtol=1e-12, regularisation=None):
+        '''
+        Precomputes the least-squares inverse of A so that each solve is
+        cheap.
+        
+        By default this is the sparse LU factorization of the normal
+        equations from factorize. Its memory is the fill-in of the
+        factors, which stays sparse for mesh fits. The solution is exact
+        but needs a regularisation if the data does not constrain every
+        parameter.
+        
+        If ``rank`` is given, A is instead approximated by its ``rank``
+        largest singular values, dropping those below ``rtol`` times the
+        largest. The dense factors take rank * (rows + columns) values,
+        so the rank bounds the memory. The fit is exact only if the rank
+        is at least the numerical rank of A; below that the smallest
+        singular modes are left out of the solution.
+        '''
+        self.svd_UT, self.svd_S, self.svd_VT = None, None, None
+        self.svd_invA = None
+        self._factor = None
+        if rank is None:
+            self.factorize(regularisation)
+            return
         from sparsesvd import sparsesvd
-        self.svd_UT, self.svd_S, self.svd_VT = sparsesvd(self.A, self.A.shape[1])
-        self.svd_invA = scipy.dot(\
-            scipy.dot(self.svd_VT.T,scipy.linalg.inv(scipy.diag(self.svd_S))),self.svd_UT)
+        UT, S, VT = sparsesvd(scipy.sparse.csc_matrix(self.A), rank)
+        keep = S > rtol * S.max()
+        self.svd_UT, self.svd_S, self.svd_VT = UT[keep], S[keep], VT[keep]
+    
+    def apply_inverse(self, Xd):
+        '''
+        Applies the precomputed inverse, either the truncated SVD
+        x = V (S^-1 (U' b)) or the factorized normal equations.
+        '''
+        if self.svd_invA is not None:
+            return scipy.dot(self.svd_invA, Xd)
+        if self.svd_S is not None:
+            return scipy.dot(self.svd_VT.T, scipy.dot(self.svd_UT, Xd) / self.svd_S)
+        return self.solve_normal_equations(Xd)
+    
+    
+    def factorize(self, regularisation=None):
+        '''
+        Factorizes the normal equations (A'A + rI) x = A'b once with a
+        sparse LU decomposition. Solves reuse the factorization, so each
+        iteration and each new data set bound to the same points only
+        costs a pair of triangular solves. The factorization is dropped
+        when the matrix is regenerated.
+        
+        A small regularisation r makes the system solvable when some
+        parameters are not constrained by the data. Without it a rank
+        deficient fit raises a ValueError.
+        '''
+        if regularisation is not None:
+            self.regularisation = regularisation
+        A = scipy.sparse.csc_matrix(self.A)
+        AtA = (A.T * A).tocsc()
+        if self.regularisation > 0:
+            AtA = AtA + self.regularisation * scipy.sparse.identity(AtA.shape[0], format='csc')
+        self._factor = None
+        try:
+            self._factor = scipy.sparse.linalg.splu(AtA.tocsc())
+        except RuntimeError:
+            raise ValueError('Normal equations are singular, the data does '
+                    'not constrain all parameters. Set a regularisation > 0 '
+                    'to factorize this fit.')
+        return self._factor
     
+    def solve_normal_equations(self, Xd):
+        if self._factor is None:
+            self.factorize()
+        return self._factor.solve(self.A.T.dot(Xd))
+    
+    def _has_factorization(self, output=False):
+        if self._factor is None and self.use_factorization and not self._singular:
+            try:
+                self.factorize()
+            except ValueError:
+                self._singular = True
+                if output:
+                    print 'Singular normal equations, solving with lsqr'
+        return self._factor is not None
     
     def solve(self, mesh, max_iterations=1000, drms=1e-9, output=False):
         td, ts = 0, 0
@@ -338,11 +525,13 @@ class Fit:
             Xd = self.get_data(mesh) * self.W
             t1 = time.time()
             
-            if self.svd_invA==None:
+            if self.svd_S is not None or self.svd_invA is not None:
+                solved_x = self.apply_inverse(Xd)
+            elif self._has_factorization(output):
+                solved_x = self.solve_normal_equations(Xd)
+            else:
                 self.lsqr_result = scipy.sparse.linalg.lsqr(self.A, Xd)
                 solved_x = self.lsqr_result[0]
-            else:
-                solved_x = scipy.dot(self.svd_invA, Xd)
                 
             mesh.update_parameters(self.param_ids, solved_x)
             t2 = time.time()
@@ -381,7 +570,16 @@ class Fit:
             
             
     def optimize(self, mesh, Xd, ftol=1e-9, xtol=1e-9, maxiter=0, output=True):
-        
+        '''
+        Fits the mesh variables to the data points Xd with leastsq.
+        
+        ``maxiter`` bounds the work as a number of objective evaluations,
+        where a finite-difference jacobian costs one evaluation per
+        variable. With an analytic jacobian the same budget allows
+        maxiter / (number of variables + 1) iterations. The default of 0
+        gives 200 (number of variables + 1) evaluations, i.e., about 200
+        iterations either way.
+        '''
         mesh.generate()
         
         Td = cKDTree(Xd)
@@ -389,14 +587,17 @@ class Fit:
         x0 = mesh.get_variables()
         t0 = time.time()
         x, success = scipy.optimize.leastsq(self.objfn, x0,
-                args=[mesh, Xd, Td], ftol=ftol, xtol=xtol,
-                maxfev=maxiter)
+                args=[mesh, Xd, Td], Dfun=self.jacfn, ftol=ftol, xtol=xtol,
+                maxfev=self._max_function_calls(maxiter, x0.size, self.jacfn))
         if output: print 'Fit Time: ', time.time()-t0
         mesh.set_variables(x)
         return mesh
     
     def optimize2(self, mesh, data, ftol=1e-9, xtol=1e-9, maxiter=0, output=True):
-        
+        '''
+        Same as optimize with a user objective_function and optional
+        jacobian_function. ``maxiter`` bounds the work in the same way.
+        '''
         mesh.generate()
         
         if self.on_start != None:
@@ -405,8 +606,9 @@ class Fit:
         x0 = mesh.get_variables()
         t0 = time.time()
         x, success = scipy.optimize.leastsq(self.objective_function,
-                x0, args=[mesh, data], ftol=ftol, xtol=xtol,
-                maxfev=maxiter)
+                x0, args=[mesh, data], Dfun=self.jacobian_function,
+                ftol=ftol, xtol=xtol, maxfev=self._max_function_calls(
+                    maxiter, x0.size, self.jacobian_function))
                 
         if output: print 'Fit Time: ', time.time()-t0
         mesh.set_variables(x)
@@ -417,6 +619,20 @@ class Fit:
         
         return mesh
     
+    def _max_function_calls(self, maxiter, num_variables, jacobian):
+        '''
+        Converts maxiter to leastsq's maxfev. Without a jacobian, MINPACK
+        counts the finite-difference evaluations, and 0 selects its
+        default of 200 (N + 1). With a jacobian only the objective calls
+        are counted, about one per iteration, so the budget is divided by
+        N + 1 to bound the same amount of work.
+        '''
+        if jacobian is None:
+            return maxiter
+        if maxiter == 0:
+            return 200
+        return max(1, maxiter // (num_variables + 1))
+    
     def objfn_mesh_to_data_closest(self, x0, args):
         mesh, Xd, Td = args[0], args[1], args[2]
         mesh.set_variables(x0)
@@ -425,7 +641,7 @@ class Fit:
         for element in mesh.elements:
             self.X[ind:ind+NXi,:] = element.evaluate(self.Xi)
             ind += NXi
-        err = Td.query(list(self.X))[0]
+        err = query_tree(Td, self.X, workers=self.workers)[0]
         return err*err
     
     def objfn_data_to_mesh_closest(self, x0, args):
@@ -436,11 +652,67 @@ class Fit:
         for element in mesh.elements:
             self.X[ind:ind+NXi,:] = element.evaluate(self.Xi)
             ind += NXi
-        Tm = cKDTree(self.X)
-        err = Tm.query(list(Xd))[0]
+        err = self._closest_points(Xd).query(self.X)[0]
         self.err = err
         return err*err
     
+    def jacfn_mesh_to_data_closest(self, x0, args):
+        '''
+        Analytic jacobian of objfn_mesh_to_data_closest.
+        '''
+        mesh, Xd, Td = args[0], args[1], args[2]
+        mesh.set_variables(x0)
+        X = self._evaluate_sample_points(mesh)
+        ii = query_tree(Td, X, workers=self.workers)[1]
+        return self._closest_point_jacobian(mesh, X, Xd[ii],
+                scipy.arange(X.shape[0]))
+    
+    def jacfn_data_to_mesh_closest(self, x0, args):
+        '''
+        Analytic jacobian of objfn_data_to_mesh_closest.
+        '''
+        mesh, Xd, Td = args[0], args[1], args[2]
+        mesh.set_variables(x0)
+        X = self._evaluate_sample_points(mesh)
+        ii = self._closest_points(Xd).query(X)[1]
+        return self._closest_point_jacobian(mesh, X, Xd, ii)
+    
+    def _closest_points(self, Xd):
+        if self._closest is None or self._closest.source is not Xd:
+            self._closest = ClosestPointEngine(Xd,
+                    num_candidates=self.num_candidates, workers=self.workers)
+        self._closest.workers = self.workers
+        return self._closest
+    
+    def _get_sampling_operator(self, mesh):
+        return mesh.build_sampling_operator(
+                [element.id for element in mesh.elements], self.Xi)
+    
+    def _evaluate_sample_points(self, mesh):
+        A = self._get_sampling_operator(mesh)
+        return A.dot(mesh._core.P).reshape((-1, self.X.shape[1]))
+    
+    def _closest_point_jacobian(self, mesh, X, Y, rows):
+        '''
+        Jacobian of the squared distances |X[rows] - Y|^2 with respect to
+        the mesh variables. The sample points are linear in the mesh
+        parameters, so dX/dx is the sampling operator restricted to the
+        variables, and each residual's gradient is 2 (X - Y) . dX/dx with
+        the closest points held fixed.
+        '''
+        num_fields = X.shape[1]
+        A = self._get_sampling_operator(mesh)
+        A = A[:, mesh._core.variable_ids]
+        D = 2 * (X[rows] - Y)
+        field_rows = (rows[:, scipy.newaxis] * num_fields +
+                scipy.arange(num_fields)).ravel()
+        J = A[field_rows].multiply(D.reshape((-1, 1)))
+        S = scipy.sparse.csr_matrix((scipy.ones(field_rows.size),
+                (scipy.repeat(scipy.arange(rows.size), num_fields),
+                 scipy.arange(field_rows.size))),
+                shape=(rows.size, field_rows.size))
+        return (S * scipy.sparse.csr_matrix(J)).toarray()
+    
     def objfn_data_to_mesh_project(self, x0, args):
         mesh, Xd, Td = args[0], args[1], args[2]
         mesh.set_variables(x0)
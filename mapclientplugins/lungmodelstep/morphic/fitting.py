@@ -446,6 +446,8 @@ class Fit():
         self.svd_S = None
         self.svd_VT = None
         self.svd_invA = None
+        self.regularisation = 0.0
+        self._factor = None
         
         if filepath!=None:
             self.load(filepath)
@@ -464,8 +466,31 @@ class Fit():
         h5Nodes[:] = self.Nodes
         h5Weights = h5f.createCArray(h5f.root, 'Weights', atom1, self.Weights.shape, filters=filters)
         h5Weights[:] = self.Weights
-        invA = h5f.createCArray(h5f.root, 'invA', atom1, self.svd_invA.shape, filters=filters)
-        invA[:,:] = self.svd_invA
+        if self.svd_invA is not None:
+            invA = h5f.createCArray(h5f.root, 'invA', atom1, self.svd_invA.shape, filters=filters)
+            invA[:,:] = self.svd_invA
+        elif self.svd_S is not None:
+            svd_UT = h5f.createCArray(h5f.root, 'svd_UT', atom1, self.svd_UT.shape, filters=filters)
+            svd_UT[:,:] = self.svd_UT
+            svd_S = h5f.createCArray(h5f.root, 'svd_S', atom1, self.svd_S.shape, filters=filters)
+            svd_S[:] = self.svd_S
+            svd_VT = h5f.createCArray(h5f.root, 'svd_VT', atom1, self.svd_VT.shape, filters=filters)
+            svd_VT[:,:] = self.svd_VT
+        elif self._factor is not None:
+            # The factorization is recomputed from the sparse matrix on load.
+            A = sparse.csc_matrix(self.A)
+            A_data = h5f.createCArray(h5f.root, 'A_data', atom1, A.data.shape, filters=filters)
+            A_data[:] = A.data
+            A_indices = h5f.createCArray(h5f.root, 'A_indices', atom2, A.indices.shape, filters=filters)
+            A_indices[:] = A.indices
+            A_indptr = h5f.createCArray(h5f.root, 'A_indptr', atom2, A.indptr.shape, filters=filters)
+            A_indptr[:] = A.indptr
+            A_shape = scipy.array([A.shape[0], A.shape[1]])
+            h5A_shape = h5f.createCArray(h5f.root, 'A_shape', atom2, A_shape.shape)
+            h5A_shape[:] = A_shape
+            reg = scipy.array([self.regularisation])
+            h5reg = h5f.createCArray(h5f.root, 'regularisation', atom1, reg.shape)
+            h5reg[:] = reg
         b = h5f.createCArray(h5f.root, 'b', atom1, self.b.shape, filters=filters)
         b[:] = self.b
         fixed = h5f.createCArray(h5f.root, 'fixed', atom1, self.fixed.shape, filters=filters)
@@ -481,7 +506,20 @@ class Fit():
         self.NWMap = h5f.root.NWMap[:,:]
         self.Nodes = h5f.root.Nodes[:]
         self.Weights = h5f.root.Weights[:]
-        self.svd_invA = h5f.root.invA[:,:]
+        if 'invA' in h5f.root:
+            self.svd_invA = h5f.root.invA[:,:]
+            self._NDoF = self.svd_invA.shape[0]
+        elif 'svd_UT' in h5f.root:
+            self.svd_UT = h5f.root.svd_UT[:,:]
+            self.svd_S = h5f.root.svd_S[:]
+            self.svd_VT = h5f.root.svd_VT[:,:]
+            self._NDoF = self.svd_VT.shape[1]
+        elif 'A_data' in h5f.root:
+            self.A = sparse.csc_matrix((h5f.root.A_data[:],
+                h5f.root.A_indices[:], h5f.root.A_indptr[:]),
+                shape=tuple(h5f.root.A_shape[:]))
+            self._NDoF = self.A.shape[1]
+            self.factorize(h5f.root.regularisation[0])
         self.b = h5f.root.b[:]
         self.fixed = h5f.root.fixed[:]
         self.NPoints = h5f.root.npbs[0]
@@ -489,7 +527,6 @@ class Fit():
         self.NFix = h5f.root.npbs[2]
         self.NSmooth = h5f.root.npbs[3]
         h5f.close()
-        self._NDoF = self.svd_invA.shape[0]
         
     
     def add_element_points(self, Elements, Xi):
@@ -567,11 +604,67 @@ class Fit():
         self.Nodes = scipy.array([n for n in Nodes])
         self.Weights = scipy.array([w for w in Weights])            
         
-    def invert_matrix(self):
+    def invert_matrix(self, rank=None, rtol=1e-12, regularisation=None):
+        '''
+        Precomputes the least-squares inverse of A so that each solve is
+        cheap.
+        
+        By default this is the sparse LU factorization of the normal
+        equations from factorize. Its memory is the fill-in of the
+        factors, which stays sparse for mesh fits. The solution is exact
+        but needs a regularisation if the data does not constrain every
+        parameter.
+        
+        If ``rank`` is given, A is instead approximated by its ``rank``
+        largest singular values, dropping those below ``rtol`` times the
+        largest. The dense factors take rank * (rows + columns) values,
+        so the rank bounds the memory. The fit is exact only if the rank
+        is at least the numerical rank of A; below that the smallest
+        singular modes are left out of the solution.
+        '''
+        self.svd_UT, self.svd_S, self.svd_VT = None, None, None
+        self.svd_invA = None
+        self._factor = None
+        if rank==None:
+            self.factorize(regularisation)
+            return
         from sparsesvd import sparsesvd
-        self.svd_UT, self.svd_S, self.svd_VT = sparsesvd(self.A, self.A.shape[1])
-        self.svd_invA = scipy.dot(\
-            scipy.dot(self.svd_VT.T,scipy.linalg.inv(scipy.diag(self.svd_S))),self.svd_UT)
+        UT, S, VT = sparsesvd(sparse.csc_matrix(self.A), rank)
+        keep = S > rtol * S.max()
+        self.svd_UT, self.svd_S, self.svd_VT = UT[keep], S[keep], VT[keep]
+    
+    def factorize(self, regularisation=None):
+        '''
+        Factorizes the normal equations (A'A + rI) x = A'b with a sparse
+        LU decomposition. A small regularisation r makes the system
+        solvable when some parameters are not constrained by the data.
+        Without it a rank deficient fit raises a ValueError.
+        '''
+        if regularisation is not None:
+            self.regularisation = regularisation
+        A = sparse.csc_matrix(self.A)
+        AtA = (A.T * A).tocsc()
+        if self.regularisation > 0:
+            AtA = AtA + self.regularisation * sparse.identity(AtA.shape[0], format='csc')
+        self._factor = None
+        try:
+            self._factor = linalg.splu(AtA.tocsc())
+        except RuntimeError:
+            raise ValueError('Normal equations are singular, the data does '
+                    'not constrain all parameters. Set a regularisation > 0 '
+                    'or a rank to invert this fit.')
+        
+    def apply_inverse(self, b):
+        '''
+        Applies the precomputed inverse, either the truncated SVD
+        x = V (S^-1 (U' b)) or the factorized normal equations. Fits
+        saved with a dense inverse are still supported.
+        '''
+        if self.svd_invA is not None:
+            return scipy.dot(self.svd_invA, b)
+        if self.svd_S is not None:
+            return scipy.dot(self.svd_VT.T, scipy.dot(self.svd_UT, b) / self.svd_S)
+        return self._factor.solve(self.A.T.dot(b))
 
         
     def update_element_xi(self):
@@ -634,6 +727,9 @@ class Fit():
                             self.fixed[NR] = 1
         
         self.A = A.tocsc()
+        self.svd_UT, self.svd_S, self.svd_VT = None, None, None
+        self.svd_invA = None
+        self._factor = None
         
     def set_data(self, Xd, mode='one-to-one', ndp=1):
         self.Xd = Xd
@@ -669,7 +765,7 @@ class Fit():
             else:
                 Xdr = self.Xd.reshape((self.Xd.size))
         elif self.data_filter=='closest':
-            if X==None:
+            if X is None:
                 raise NameError('Need mesh node values for find closest data points')
             self.DI = self.find_closest_data_indices(X)
             if self.Nd>1:
@@ -683,11 +779,11 @@ class Fit():
         
         
     def solve_iteration(self, Xdr):
-        if self.svd_invA==None:
+        if self.svd_S is None and self.svd_invA is None and self._factor is None:
             self.lsqr_result = linalg.lsqr(self.A, Xdr)
             self.x = self.lsqr_result[0].reshape((self.NDoF()/3,3))
         else:
-            svd_x = scipy.dot(self.svd_invA, Xdr)
+            svd_x = self.apply_inverse(Xdr)
             self.x = svd_x.reshape((self.NDoF()/3,3))
         
         
@@ -711,7 +807,7 @@ class Fit():
             
     
     def rms_error(self, Xn=None):
-        if Xn==None:
+        if Xn is None:
             Xn = self.x
         Xe = self.compute_surface_points(Xn)
         dx = Xe - self.Xd_closest.reshape((self.Xd_closest.shape[0]/3,3))
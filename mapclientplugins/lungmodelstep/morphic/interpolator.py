@@ -1,3 +1,7 @@
+import collections
+import hashlib
+import threading
+
 import numpy
 import numpy.linalg
 
@@ -26,34 +30,249 @@ def weights(basis, X, deriv=None):
     basis_functions, dimensions = _get_basis_functions(basis, deriv)
     X = _process_x(X, dimensions)
     
-    W = []
-    for bf in basis_functions:
-        if bf[0].__name__[0] == 'T':
-            W.append(bf[0](X[:, bf[1]]))
-        else:
-            W.append(bf[0](X[:, bf[1]])[0])
+    W = [_evaluate_basis_function(bf, X) for bf in basis_functions]
+    
+    return _tensor_product(basis, dimensions, W)
+
+
+def weights_derivatives(basis, X, order=1):
+    """
+    Calculates the interpolant value weights and all derivative weights
+    up to ``order`` for points X in one pass. Each 1D basis function is
+    evaluated once and shared between the value and derivatives.
+    
+    :param basis: interpolation function in each direction.
+    :type basis: list of strings
+    :param X: locations to calculate interpolant weights
+    :type X: list or numpy array (npoints, ndims)
+    :param order: highest derivative order, 1 or 2
+    :type order: int
+    :return: weights for the derivatives given by
+        :func:`derivative_orders`
+    :rtype: numpy array, size: (nderivs, npoints, nweights)
+    
+    >>> import numpy
+    >>> x = numpy.array([[0.13, 0.23], [0.77, 0.06]])
+    >>> W = weights_derivatives(['L1', 'L2'], x)
+    >>> numpy.allclose(W[2], weights(['L1', 'L2'], x, deriv=[0, 1]))
+    True
     
+    """
+    dimensions = _get_basis_functions(basis, None)[1]
+    X = _process_x(X, dimensions)
+    
+    evaluated = {}
+    WW = None
+    derivs = derivative_orders(dimensions, order)
+    for ind, deriv in enumerate(derivs):
+        basis_functions = _get_basis_functions(basis, deriv)[0]
+        W = []
+        for bf in basis_functions:
+            key = (bf[0], tuple(bf[1]))
+            if key not in evaluated:
+                evaluated[key] = _evaluate_basis_function(bf, X)
+            W.append(evaluated[key])
+        Wd = _tensor_product(basis, dimensions, W)
+        if WW is None:
+            WW = numpy.zeros((len(derivs),) + Wd.shape)
+        WW[ind] = Wd
+    
+    return WW
+
+
+def derivative_orders(dimensions, order=1):
+    """
+    Returns the derivatives evaluated by :func:`weights_derivatives`:
+    the value, the first derivative in each dimension and, for order 2,
+    the second derivatives ``d2/dxi_j dxi_k`` for ``j <= k``.
+    
+    >>> derivative_orders(2, order=2)
+    [[0, 0], [1, 0], [0, 1], [2, 0], [1, 1], [0, 2]]
+    
+    """
+    derivs = [[0] * dimensions]
+    for k in range(dimensions):
+        deriv = [0] * dimensions
+        deriv[k] = 1
+        derivs.append(deriv)
+    if order >= 2:
+        for j in range(dimensions):
+            for k in range(j, dimensions):
+                deriv = [0] * dimensions
+                deriv[j] += 1
+                deriv[k] += 1
+                derivs.append(deriv)
+    if order > 2:
+        raise ValueError('Derivatives above second order not supported')
+    return derivs
+
+
+def _evaluate_basis_function(bf, X):
+    if bf[0].__name__[0] == 'T':
+        return bf[0](X[:, bf[1]])
+    else:
+        return bf[0](X[:, bf[1]])[0]
+
+
+def _tensor_product(basis, dimensions, W):
     BPInd = _get_basis_product_indices(basis, dimensions, W)             
     
     if BPInd is None:
         return W[0]
-        
-    WW = numpy.zeros((X.shape[0], len(BPInd)))
+    
+    # One gather of the 1D weight columns per dimension and one product.
+    WW = W[0][:, BPInd[:, 0]] * W[1][:, BPInd[:, 1]]
     if dimensions == 3:
-        for ind, ii in enumerate(BPInd):
-            WW[:, ind] = W[0][:, ii[0]] * W[1][:, ii[1]] * W[2][:, ii[2]]
-    else:
-        for ind, ii in enumerate(BPInd):
-            WW[:, ind] = W[0][:, ii[0]] * W[1][:, ii[1]]
+        WW *= W[2][:, BPInd[:, 2]]
     
     return WW
 
 
+class WeightsCache(object):
+    """
+    Least-recently-used cache of basis weight matrices.
+    
+    Evaluation repeatedly asks for the weights of the same basis on the
+    same xi grids, e.g., surface sampling and Gauss points. Weights are
+    cached by basis, derivative and a digest of the xi array and are
+    returned read-only, so callers must copy them before modifying.
+    The cached weights are bounded by ``max_bytes`` in total, a weight
+    matrix larger than that is computed but not cached.
+    """
+    
+    def __init__(self, max_size=256, max_bytes=32 << 20):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+    
+    def weights(self, basis, X, deriv=None):
+        return self._lookup(basis, X, None if deriv is None else tuple(deriv),
+                            lambda: weights(basis, X, deriv=deriv))
+    
+    def weights_derivatives(self, basis, X, order=1):
+        return self._lookup(basis, X, ('order', order),
+                            lambda: weights_derivatives(basis, X, order=order))
+    
+    def _lookup(self, basis, X, deriv_key, compute):
+        Xa = numpy.ascontiguousarray(X, dtype=float)
+        key = (tuple(basis), deriv_key, Xa.shape, Xa.dtype.str,
+               hashlib.sha1(Xa.view(numpy.uint8)).digest())
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        
+        W = compute()
+        nbytes = W.nbytes + len(key[-1])
+        if nbytes > self.max_bytes:
+            return W
+        W.flags.writeable = False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+            self._entries[key] = (W, nbytes)
+            self._nbytes += nbytes
+            while (len(self._entries) > self.max_size or
+                   self._nbytes > self.max_bytes):
+                self._nbytes -= self._entries.popitem(last=False)[1][1]
+        return W
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+    
+    def stats(self):
+        """
+        Returns the number of cache hits, misses, cached matrices and
+        cached bytes.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries), 'bytes': self._nbytes}
+
+
+weights_cache = WeightsCache()
+
+
+def cached_weights(basis, X, deriv=None):
+    """
+    Same as :func:`weights` but memoized in ``weights_cache``. The
+    returned array is read-only.
+    """
+    return weights_cache.weights(basis, X, deriv=deriv)
+
+
+def cached_weights_derivatives(basis, X, order=1):
+    """
+    Same as :func:`weights_derivatives` but memoized in
+    ``weights_cache``. The returned array is read-only.
+    """
+    return weights_cache.weights_derivatives(basis, X, order=order)
+
+
+# Column orderings of the tensor-product weights for Hermite bases.
+_H3H3_BPIND = numpy.array([
+    [0, 0], [1, 0], [0, 1], [1, 1],
+    [2, 0], [3, 0], [2, 1], [3, 1],
+    [0, 2], [1, 2], [0, 3], [1, 3],
+    [2, 2], [3, 2], [2, 3], [3, 3]], dtype=numpy.intp)
+
+_H3H3H3_BPIND = numpy.array([
+    [0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0],
+    [0, 0, 1], [1, 0, 1], [0, 1, 1], [1, 1, 1],
+    [2, 0, 0], [3, 0, 0], [2, 1, 0], [3, 1, 0],
+    [2, 0, 1], [3, 0, 1], [2, 1, 1], [3, 1, 1],
+    [0, 2, 0], [1, 2, 0], [0, 3, 0], [1, 3, 0],
+    [0, 2, 1], [1, 2, 1], [0, 3, 1], [1, 3, 1],
+    [2, 2, 0], [3, 2, 0], [2, 3, 0], [3, 3, 0],
+    [2, 2, 1], [3, 2, 1], [2, 3, 1], [3, 3, 1],
+    
+    [0, 0, 2], [1, 0, 2], [0, 1, 2], [1, 1, 2],
+    [0, 0, 3], [1, 0, 3], [0, 1, 3], [1, 1, 3],
+    [2, 0, 2], [3, 0, 2], [2, 1, 2], [3, 1, 2],
+    [2, 0, 3], [3, 0, 3], [2, 1, 3], [3, 1, 3],
+    [0, 2, 2], [1, 2, 2], [0, 3, 2], [1, 3, 2],
+    [0, 2, 3], [1, 2, 3], [0, 3, 3], [1, 3, 3],
+    [2, 2, 2], [3, 2, 2], [2, 3, 2], [3, 3, 2],
+    [2, 2, 3], [3, 2, 3], [2, 3, 3], [3, 3, 3]], dtype=numpy.intp)
+
+_BPIND_CACHE = {}
+
+
 def _get_basis_product_indices(basis, dimensions, W):
     """
     Returns the indicies for the product between the weights for each
-    interpolant for basis functions.
+    interpolant for basis functions as an (nweights, ndims) integer
+    array. The arrays are compiled once per basis.
+    """
+    key = (tuple(basis), dimensions, tuple(w.shape[1] for w in W))
+    if key not in _BPIND_CACHE:
+        _BPIND_CACHE[key] = _compile_basis_product_indices(
+            basis, dimensions, W)
+    return _BPIND_CACHE[key]
+
+
+def _tensor_product_indices(sizes):
     """
+    Returns the indices of a tensor product with the first dimension
+    varying fastest.
+    """
+    grids = numpy.indices(sizes[::-1]).reshape(len(sizes), -1)[::-1]
+    return numpy.ascontiguousarray(grids.T, dtype=numpy.intp)
+
+
+def _compile_basis_product_indices(basis, dimensions, W):
     BPInd = None
     if dimensions == 1:
         return None
@@ -64,44 +283,19 @@ def _get_basis_product_indices(basis, dimensions, W):
             if (basis[0][0] == 'L' and basis[1][0] == 'L') or \
                (basis[0][0] == 'L' and basis[1][0] == 'H') or \
                (basis[0][0] == 'H' and basis[1][0] == 'L'):
-                BPInd = []
-                for ind1 in range(W[1].shape[1]):
-                    for ind0 in range(W[0].shape[1]):
-                        BPInd.append([ind0, ind1])
-            elif basis == ['H3', 'H3']:
-                BPInd = [[0, 0], [1, 0], [0, 1], [1, 1],
-                      [2, 0], [3, 0], [2, 1], [3, 1],
-                      [0, 2], [1, 2], [0, 3], [1, 3],
-                      [2, 2], [3, 2], [2, 3], [3, 3]]
+                BPInd = _tensor_product_indices(
+                    [W[0].shape[1], W[1].shape[1]])
+            elif list(basis) == ['H3', 'H3']:
+                BPInd = _H3H3_BPIND
             else:
                 raise ValueError('Basis combination not supported')
     elif dimensions == 3:
         if len(basis) == 3:
             if (basis[0][0] == 'L' and basis[1][0] == 'L' and basis[2][0] == 'L'):
-                BPInd = []
-                for ind2 in range(W[2].shape[1]):
-                    for ind1 in range(W[1].shape[1]):
-                        for ind0 in range(W[0].shape[1]):
-                            BPInd.append([ind0, ind1, ind2])
-            elif basis == ['H3', 'H3', 'H3']:
-                BPInd = [
-                    [0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0],
-                    [0, 0, 1], [1, 0, 1], [0, 1, 1], [1, 1, 1],
-                    [2, 0, 0], [3, 0, 0], [2, 1, 0], [3, 1, 0],
-                    [2, 0, 1], [3, 0, 1], [2, 1, 1], [3, 1, 1],
-                    [0, 2, 0], [1, 2, 0], [0, 3, 0], [1, 3, 0],
-                    [0, 2, 1], [1, 2, 1], [0, 3, 1], [1, 3, 1],
-                    [2, 2, 0], [3, 2, 0], [2, 3, 0], [3, 3, 0],
-                    [2, 2, 1], [3, 2, 1], [2, 3, 1], [3, 3, 1],
-                    
-                    [0, 0, 2], [1, 0, 2], [0, 1, 2], [1, 1, 2],
-                    [0, 0, 3], [1, 0, 3], [0, 1, 3], [1, 1, 3],
-                    [2, 0, 2], [3, 0, 2], [2, 1, 2], [3, 1, 2],
-                    [2, 0, 3], [3, 0, 3], [2, 1, 3], [3, 1, 3],
-                    [0, 2, 2], [1, 2, 2], [0, 3, 2], [1, 3, 2],
-                    [0, 2, 3], [1, 2, 3], [0, 3, 3], [1, 3, 3],
-                    [2, 2, 2], [3, 2, 2], [2, 3, 2], [3, 3, 2],
-                    [2, 2, 3], [3, 2, 3], [2, 3, 3], [3, 3, 3]]
+                BPInd = _tensor_product_indices(
+                    [W[0].shape[1], W[1].shape[1], W[2].shape[1]])
+            elif list(basis) == ['H3', 'H3', 'H3']:
+                BPInd = _H3H3H3_BPIND
             else:
                 raise ValueError('Basis combination not supported')
         else:
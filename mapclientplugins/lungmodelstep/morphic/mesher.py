@@ -25,6 +25,7 @@ interpolation.
 
 
 '''
+import collections
 import datetime
 import os
 import sys
@@ -34,6 +35,7 @@ from scipy import linalg
 
 import core
 import discretizer
+import fasteval
 import utils
 
 class Metadata(object):
@@ -165,7 +167,7 @@ class Node(object):
         self.shape = (0, 0, 0)
         self._added = False
         self._uptodate = False
-        self.mesh._regenerate = True
+        self.mesh._dirty_nodes.add(uid)
         self.mesh._reupdate = True
         
     @property
@@ -236,14 +238,16 @@ class Node(object):
             self.num_modes = values.shape[2]
         
         # Updates the values in core if they exist otherwise adds them.
+        # Only new parameters change the element maps, updated values
+        # just need the dependent and PCA nodes updating.
         params = values.reshape(self.num_values)
         if self._added:
             self.mesh._core.update_params(self.cids, params)
         else:
             self.cids = self.mesh._core.add_params(params)
+            self.mesh._dirty_nodes.add(self.id)
         
         self._added = True
-        self.mesh._regenerate = True
         self.mesh._reupdate = True
         
     def get_values(self, index=None):
@@ -426,7 +430,7 @@ class Element(object):
         
         self._set_shape()
         
-        self.mesh._regenerate = True
+        self.mesh._dirty_elements[self] = None
         self.mesh._reupdate = True
     
     @property
@@ -450,6 +454,8 @@ class Element(object):
     @nodes.setter
     def nodes(self, nodes):
         self.node_ids = [node.id for node in nodes]
+        self.mesh._dirty_elements[self] = None
+        self.mesh._reupdate = True
     
     def _set_shape(self):
         if self.basis:
@@ -581,6 +587,25 @@ class Element(object):
                             self.cid, xi, deriv=deriv)
         
     
+    def evaluate_derivatives(self, xi, order=1):
+        '''
+        Evaluates the element and all its derivatives up to ``order`` at
+        xi in one pass. Returns an ``(nderivs, npoints, nfields)`` array
+        with the value first, then the first derivatives with respect to
+        each xi and, for order 2, the second derivatives. If a single xi
+        is given the points axis is dropped.
+        '''
+        xi = numpy.asarray(xi, dtype=float)
+        single = xi.ndim < 2 and not (self.shape == 'line' and xi.size > 1)
+        if xi.ndim == 0:
+            xi = numpy.array([[xi]])
+        elif xi.ndim == 1:
+            xi = numpy.array([xi]).T if self.shape == 'line' else numpy.array([xi])
+        X = self.mesh._core.evaluate_derivatives(self.cid, xi, order=order)
+        if single:
+            return X[:, 0]
+        return X
+    
     def integrate(self, fields, func=None, ng=4):
         '''
         Integration using gaussian quadrature.
@@ -641,38 +666,25 @@ class Element(object):
             
     def area(self, ng=3):
         
-        def _area_integral(X):
-            A = []
-            for x in X:
-                x = x.reshape((2, x.size/2))
-                c = numpy.cross(x[0], x[1])
-                A.append(numpy.sqrt((c * c).sum()))
-            return A
-            
         if self.shape == 'quad':
-            fields = []
-            for i in range(self.num_fields):
-                fields.append([i, 1, 0])
-                fields.append([i, 0, 1])
-            return self.integrate(fields, func=_area_integral, ng=ng)
+            Xi, W = self.core.get_gauss_points([ng, ng])
+            D = self.mesh._core.evaluate_derivatives(self.cid, Xi)
+            c = numpy.cross(D[1], D[2])
+            if c.ndim == 1:
+                c = c[:, numpy.newaxis]
+            return numpy.dot(W, numpy.sqrt((c * c).sum(1)))
         else:
             raise TypeError('You can only calculate the area '
                 + 'of a 2D quad element. Triangles not implemented.')
     
     def volume(self, ng=3):
-         
-        def _volume_integral(X):
-            V = X[:,0] * (X[:,4] * X[:,8] - X[:,5] * X[:,7]) - X[:,1] * (X[:,3] * X[:,8]
-                - X[:,5] * X[:,6]) + X[:,2] * (X[:,3] * X[:,7] - X[:,4] * X[:,6])
-            return V
-            
+        
         if self.shape == 'hexagonal':
-            fields = []
-            for i in range(self.num_fields):
-                fields.append([i, 1, 0, 0])
-                fields.append([i, 0, 1, 0])
-                fields.append([i, 0, 0, 1])
-            return abs(self.integrate(fields, func=_volume_integral, ng=ng))
+            Xi, W = self.core.get_gauss_points([ng, ng, ng])
+            D = self.mesh._core.evaluate_derivatives(self.cid, Xi)
+            # Jacobian (npoints x fields x xi) from the first derivatives.
+            J = D[1:4].transpose(1, 2, 0)
+            return abs(numpy.dot(W, numpy.linalg.det(J)))
         else:
             raise TypeError('You can only calculate the volume '
                 + 'of a 3D hexagonal element. Triangles not implemented.')
@@ -692,9 +704,8 @@ class Element(object):
             Xi = numpy.array([[0.1, 0.1], [0.3, 0.2], [0.7, 0.2]])
         
         '''
-        dx1 = self.mesh._core.evaluate(self.cid, Xi, deriv=[1, 0])
-        dx2 = self.mesh._core.evaluate(self.cid, Xi, deriv=[0, 1])
-        return numpy.cross(dx1, dx2)
+        D = self.mesh._core.evaluate_derivatives(self.cid, Xi)
+        return numpy.cross(D[1], D[2])
     
     def _project_objfn(self, xi, *args):
         x = args[0]
@@ -878,6 +889,15 @@ class Mesh(object):
         self.core = self._core
         self._regenerate = True
         self._reupdate = True
+        # Nodes and elements changed since the last generate, and the
+        # elements using each node, for incremental regeneration.
+        self._dirty_nodes = set()
+        self._dirty_elements = collections.OrderedDict()
+        self._node_elements = {}
+        # Sparse sampling operators and surface triangulations, cleared
+        # when the element maps change.
+        self._sampling_operators = collections.OrderedDict()
+        self._tessellations = collections.OrderedDict()
         
         self.auto_add_faces = True;
         self.auto_add_lines = True;
@@ -1530,14 +1550,60 @@ class Mesh(object):
             self._update_dependent_nodes()
             self._core.generate_element_map(self)
             self._core.generate_dependent_node_map(self)
+            self._node_elements = {}
+            self._add_node_elements(self.elements)
+            self._clear_sampling_cache()
+            self._dirty_nodes.clear()
+            self._dirty_elements.clear()
             self._regenerate = False
             self._reupdate = True
+        elif self._dirty_nodes or self._dirty_elements:
+            self._generate_incremental()
         
         if self._reupdate == True:
             self._core.update_pca_nodes()
             self._core.update_dependent_nodes()
             self._reupdate = False
         
+    def _generate_incremental(self):
+        '''
+        Remaps only the new elements and the elements using nodes whose
+        parameters were added since the last generate.
+        '''
+        dirty_nodes = [self.nodes[nid] for nid in self._dirty_nodes if nid in self.nodes]
+        for node in dirty_nodes:
+            if node._type == 'dependent' and node._added == False:
+                self._update_dependent_nodes()
+                break
+        
+        # New elements are appended in the order they were created.
+        dirty_elements = [elem for elem in self._dirty_elements if elem.id in self.elements]
+        elements = set()
+        for nid in self._dirty_nodes:
+            elements.update(self._node_elements.get(nid, ()))
+        elements.difference_update(dirty_elements)
+        elements = list(elements) + dirty_elements
+        self._core.update_element_map(elements)
+        if elements:
+            self._clear_sampling_cache()
+        self._add_node_elements(elements)
+        
+        if self._core.DNMap or any(node._type == 'dependent' for node in dirty_nodes):
+            self._core.generate_dependent_node_map(self)
+        
+        self._dirty_nodes.clear()
+        self._dirty_elements.clear()
+        self._reupdate = True
+    
+    def _clear_sampling_cache(self):
+        self._sampling_operators.clear()
+        self._tessellations.clear()
+    
+    def _add_node_elements(self, elements):
+        for elem in elements:
+            for nid in elem.node_ids:
+                self._node_elements.setdefault(nid, set()).add(elem)
+    
     def update(self, force=False):
         '''
         Updates the dependent node. This update may be required if some
@@ -1609,6 +1675,70 @@ class Mesh(object):
             
         return X
     
+    def evaluate_derivatives(self, element_ids, xi, order=1):
+        '''
+        Evaluates the elements and all their derivatives up to ``order``
+        at xi in one pass per element. Returns an
+        ``(nderivs, nelements * npoints, nfields)`` array with the value,
+        the first derivatives and, for order 2, the second derivatives.
+        '''
+        self.generate()
+        xi = numpy.asarray(xi, dtype=float)
+        if len(xi.shape) == 1:
+            xi = numpy.array([xi]).T
+        
+        if not isinstance(element_ids, list):
+            element_ids = [element_ids]
+        
+        elements = self.elements[element_ids]
+        if all(elem.basis == elements[0].basis for elem in elements):
+            return self._core.evaluates_derivatives(
+                    [elem.cid for elem in elements], xi, order=order)
+        return numpy.concatenate([self._core.evaluate_derivatives(
+                elem.cid, xi, order=order) for elem in elements], axis=1)
+    
+    def build_sampling_operator(self, elements=None, xi=None, deriv=None):
+        '''
+        Returns a sparse CSR matrix ``A`` mapping the mesh parameters to
+        the field values, or derivatives, at xi on each element, so that
+        ``A.dot(mesh.core.P).reshape(-1, num_fields)`` equals
+        ``mesh.evaluate(elements, xi, deriv)``. Re-evaluating after the
+        parameters change is then one sparse product. Operators are cached
+        until the element maps are regenerated.
+        
+        >>> mesh = Mesh()
+        >>> n = mesh.add_stdnode(1, [0, 0])
+        >>> n = mesh.add_stdnode(2, [1, 2])
+        >>> e = mesh.add_element(1, ['L1'], [1, 2])
+        >>> A = mesh.build_sampling_operator([1], [[0.25], [0.5]])
+        >>> A.dot(mesh.core.P).reshape(-1, 2).tolist()
+        [[0.25, 0.5], [0.5, 1.0]]
+        '''
+        self.generate()
+        if elements is None:
+            elements = [elem.id for elem in self.elements]
+        elif not isinstance(elements, list):
+            elements = [elements]
+        xi = numpy.asarray(xi, dtype=float)
+        if len(xi.shape) == 1:
+            xi = numpy.array([xi]).T
+        
+        key = (tuple(elements), xi.shape, xi.tobytes(),
+               None if deriv is None else tuple(deriv), self._core.P.size)
+        A = self._sampling_operators.pop(key, None)
+        if A is None:
+            num_fields = self._core.EIndex[self.elements[elements[0]].cid].shape[0]
+            fem = fasteval.FEMatrix(
+                (len(elements) * xi.shape[0] * num_fields, self._core.P.size))
+            fem.add_mesh(self)
+            fem.add_element_points(elements, xi, deriv=deriv)
+            fem.tocsr()
+            A = fem.A
+        self._sampling_operators[key] = A
+        while len(self._sampling_operators) > 32:
+            self._sampling_operators.popitem(last=False)
+        return A
+    
     def normal(self, element_ids, xi, normalise=False):
         self.generate()
         if isinstance(xi, list):
@@ -1641,14 +1771,10 @@ class Mesh(object):
         return X
     
     def deformation_gradient_tensor(self, deformed_mesh, xi):
-        dx1 = self.elements[1].evaluate(xi, deriv=[1,0])
-        dx2 = self.elements[1].evaluate(xi, deriv=[0,1])
-        dx = numpy.array([dx1, dx2])
+        dx = self.elements[1].evaluate_derivatives(xi)[1:3]
         invdx = linalg.inv(dx)
         
-        dX1 = deformed_mesh.elements[1].evaluate(xi, deriv=[1,0])
-        dX2 = deformed_mesh.elements[1].evaluate(xi, deriv=[0,1])
-        dX = numpy.array([dX1, dX2])
+        dX = deformed_mesh.elements[1].evaluate_derivatives(xi)[1:3]
         invdX = linalg.inv(dX)
         F = numpy.dot(invdx, dX.T)
         invF = linalg.inv(F)
@@ -1700,7 +1826,13 @@ class Mesh(object):
             Xl.append(self._core.evaluate(elem.cid, xi))
         return Xl
         
-    def get_surfaces(self, res=8, elements=None, groups=None, include_xi=False):
+    def get_surfaces(self, res=8, elements=None, groups=None, include_xi=False,
+            params=None):
+        '''
+        Returns the vertices and triangles of the element surfaces. The
+        vertices are evaluated with ``params`` instead of the mesh
+        parameters if given, which leaves the mesh unchanged.
+        '''
         self.generate()
         
         if elements == None:
@@ -1710,48 +1842,35 @@ class Mesh(object):
                 Elements = self.elements.get_groups(groups)
         else:
             Elements = self.elements[elements]
-        
-        XiT, TT = discretizer.xi_grid(shape='tri', res=res)
-        XiQ, TQ = discretizer.xi_grid(shape='quad', res=res)
-        NPT, NTT = XiT.shape[0], TT.shape[0]
-        NPQ, NTQ = XiQ.shape[0], TQ.shape[0]
-        
-        NP, NT = 0, 0
-        for elem in Elements:
-            if elem.shape == 'tri':
-                NP += NPT
-                NT += NTT
-            elif elem.shape == 'quad':
-                NP += NPQ
-                NT += NTQ
-                
-        X = numpy.zeros((NP, elem.nodes[0].num_fields))
-        T = numpy.zeros((NT, 3), dtype='uint32')
-        if include_xi:
-            Xi = numpy.zeros((NP, 2))
-        np, nt = 0, 0
-        for elem in Elements:
-            if elem.shape == 'tri':
-                X[np:np+NPT,:] = self._core.evaluate(elem.cid, XiT)
-                if include_xi:
-                    Xi[np:np+NPT,:] = XiT
-                T[nt:nt+NTT,:] = TT + np
-                np += NPT
-                nt += NTT
-            elif elem.shape == 'quad':
-                X[np:np+NPQ,:] = self._core.evaluate(elem.cid, XiQ)
-                T[nt:nt+NTQ,:] = TQ + np
-                if include_xi:
-                    Xi[np:np+NPQ,:] = XiQ
-                np += NPQ
-                nt += NTQ
-        if include_xi:
-            return X, T, Xi
-        return X, T
+        Elements = list(Elements)
+        
+        key = ('surfaces', res, tuple(elem.id for elem in Elements), self._core.P.size)
+        tessellation = self._tessellations.get(key)
+        if tessellation is None:
+            XiT, TT = discretizer.xi_grid(shape='tri', res=res)
+            XiQ, TQ = discretizer.xi_grid(shape='quad', res=res)
+            grids = {'tri': (XiT, TT), 'quad': (XiQ, TQ)}
+            patches = []
+            for elem in Elements:
+                if elem.shape in grids:
+                    Xi, T = grids[elem.shape]
+                    patches.append((elem.id, Xi, T, Xi))
+            tessellation = self._add_tessellation(key, patches)
+        return self._evaluate_tessellation(tessellation, include_xi, params)
         
     def get_faces(self, res=8, exterior_only=True, include_xi=False, elements=None):
         self.generate()
-
+        
+        key = ('faces', res, exterior_only,
+               None if elements is None else tuple(elements), self.faces.size(),
+               self._core.P.size)
+        tessellation = self._tessellations.get(key)
+        if tessellation is None:
+            tessellation = self._add_tessellation(
+                key, self._get_face_patches(res, exterior_only, elements))
+        return self._evaluate_tessellation(tessellation, include_xi)
+    
+    def _get_face_patches(self, res, exterior_only, elements):
         if elements == None:
             Faces = self.faces
         else:
@@ -1767,64 +1886,77 @@ class Mesh(object):
 
         XiT, TT = discretizer.xi_grid(shape='tri', res=res)
         XiQ, TQ = discretizer.xi_grid(shape='quad', res=res)
-        NPT, NTT = XiT.shape[0], TT.shape[0]
-        NPQ, NTQ = XiQ.shape[0], TQ.shape[0]
-        
-        XiQ0 = numpy.zeros(NPQ)
-        XiQ1 = numpy.ones(NPQ)
         
-        NP, NT = 0, 0
+        # Element xi of each face of a hexagonal element.
+        XiQ0 = numpy.zeros(XiQ.shape[0])
+        XiQ1 = numpy.ones(XiQ.shape[0])
+        XiF = [numpy.array([XiQ[:,0], XiQ[:,1], XiQ0]).T,
+               numpy.array([XiQ[:,0], XiQ[:,1], XiQ1]).T,
+               numpy.array([XiQ[:,0], XiQ0, XiQ[:,1]]).T,
+               numpy.array([XiQ[:,0], XiQ1, XiQ[:,1]]).T,
+               numpy.array([XiQ0, XiQ[:,0], XiQ[:,1]]).T,
+               numpy.array([XiQ1, XiQ[:,0], XiQ[:,1]]).T]
+        
+        patches = []
         for face in Faces:
+            elem = self.elements[face.element_faces[0][0]]
+            face_index = face.element_faces[0][1]
             if face.shape == 'tri':
-                NP += NPT
-                NT += NTT
+                patches.append((elem.id, XiT, TT, XiT))
             elif face.shape == 'quad':
-                NP += NPQ
-                NT += NTQ
-                
-        X = numpy.zeros((NP, 3))#######TODO#####face.nodes[0].num_fields))
+                if elem.dimensions == 2:
+                    patches.append((elem.id, XiQ, TQ, XiQ))
+                else:
+                    patches.append((elem.id, XiF[face_index], TQ, XiQ))
+        return patches
+    
+    def _add_tessellation(self, key, patches):
+        '''
+        Compiles the triangulation of element patches, each given as
+        (element id, element xi, triangles, face xi), into the triangles,
+        face xi and a sparse sampling operator for the vertices, so that
+        only the vertex positions are computed on later calls.
+        '''
+        NP = sum(patch[1].shape[0] for patch in patches)
+        NT = sum(patch[2].shape[0] for patch in patches)
         T = numpy.zeros((NT, 3), dtype='uint32')
-        if include_xi:
-            Xi = numpy.zeros((NP, 2))
+        Xi = numpy.zeros((NP, 2))
+        batches = collections.OrderedDict()
         np, nt = 0, 0
-        for face in Faces:
-            if face.shape == 'tri':
-                X[np:np+NPT,:] = self._core.evaluate(face.cid, XiT)
-                if include_xi:
-                    Xi[np:np+NPT,:] = XiT
-                T[nt:nt+NTT,:] = TT + np
-                np += NPT
-                nt += NTT
-            elif face.shape == 'quad':
-                elem = self.elements[face.element_faces[0][0]]
-                face_index = face.element_faces[0][1]
-                if face_index == 0:
-                    X[np:np+NPQ,:] = self._core.evaluate(elem.cid,
-                        numpy.array([XiQ[:,0], XiQ[:,1], XiQ0]).T)
-                elif face_index == 1:
-                    X[np:np+NPQ,:] = self._core.evaluate(elem.cid,
-                        numpy.array([XiQ[:,0], XiQ[:,1], XiQ1]).T)
-                elif face_index == 2:
-                    X[np:np+NPQ,:] = self._core.evaluate(elem.cid,
-                        numpy.array([XiQ[:,0], XiQ0, XiQ[:,1]]).T)
-                elif face_index == 3:
-                    X[np:np+NPQ,:] = self._core.evaluate(elem.cid,
-                        numpy.array([XiQ[:,0], XiQ1, XiQ[:,1]]).T)
-                elif face_index == 4:
-                    X[np:np+NPQ,:] = self._core.evaluate(elem.cid,
-                        numpy.array([XiQ0, XiQ[:,0], XiQ[:,1]]).T)
-                elif face_index == 5:
-                    X[np:np+NPQ,:] = self._core.evaluate(elem.cid,
-                        numpy.array([XiQ1, XiQ[:,0], XiQ[:,1]]).T)
-                    
-                T[nt:nt+NTQ,:] = TQ + np
-                if include_xi:
-                    Xi[np:np+NPQ,:] = XiQ
-                np += NPQ
-                nt += NTQ
+        for eid, xi, tri, face_xi in patches:
+            batch = batches.setdefault(id(xi), (xi, [], []))
+            batch[1].append(eid)
+            batch[2].append(np)
+            Xi[np:np+xi.shape[0],:] = face_xi
+            T[nt:nt+tri.shape[0],:] = tri + np
+            np += xi.shape[0]
+            nt += tri.shape[0]
+        
+        num_fields = 3
+        if len(patches) > 0:
+            num_fields = self._core.EIndex[self.elements[patches[0][0]].cid].shape[0]
+        fem = fasteval.FEMatrix((NP * num_fields, self._core.P.size))
+        fem.add_mesh(self)
+        for xi, eids, offsets in batches.values():
+            fem.add_element_points(eids, xi, point_offsets=offsets)
+        fem.tocsr()
+        
+        T.flags.writeable = False
+        Xi.flags.writeable = False
+        tessellation = (fem.A, T, Xi, num_fields)
+        self._tessellations[key] = tessellation
+        while len(self._tessellations) > 16:
+            self._tessellations.popitem(last=False)
+        return tessellation
+    
+    def _evaluate_tessellation(self, tessellation, include_xi, params=None):
+        A, T, Xi, num_fields = tessellation
+        if params is None:
+            params = self._core.P
+        X = A.dot(params).reshape(-1, num_fields)
         if include_xi:
-            return X, T, Xi
-        return X, T
+            return X, T.copy(), Xi.copy()
+        return X, T.copy()
         
     def append_lines(self, lines, elements, lindex, res=100):
         L = ((None, 0, 0), (None, 1, 0), (0, None, 0), (1, None, 0),
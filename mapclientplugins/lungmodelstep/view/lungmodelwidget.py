@@ -1,6 +1,7 @@
-from PySide import QtGui
+from PySide import QtCore, QtGui
 
 from mapclientplugins.lungmodelstep.view.ui_lungmodelwidget import Ui_LungModelWidget
+from mapclientplugins.lungmodelstep.view.morphscheduler import MorphScheduler
 
 
 class LungModelWidget(QtGui.QWidget):
@@ -9,6 +10,10 @@ class LungModelWidget(QtGui.QWidget):
         super(LungModelWidget, self).__init__(parent)
         self._meshModel = model.getMeshModel()
         self._pcaModel = pcaModelData
+        self._morphScheduler = MorphScheduler(self._pcaModel, self)
+        self._morphTimer = QtCore.QTimer(self)
+        self._morphTimer.setSingleShot(True)
+        self._morphTimer.setInterval(20)
         self._modeDict = {
             'modeOne': 0.0,
             'modeTwo': 0.0,
@@ -27,6 +32,7 @@ class LungModelWidget(QtGui.QWidget):
         self._ui.sceneviewer_widget.setContext(model.getContext())
         self._initialUiState()
         self._makeConnections()
+        self._morphScheduler.start()
 
     def _makeConnections(self):
         self._ui.sceneviewer_widget.graphicsInitialized.connect(self._graphicsInitialized)
@@ -46,10 +52,26 @@ class LungModelWidget(QtGui.QWidget):
         self._ui.modeFour_doubleSpinBox.valueChanged.connect(self._modeFourChanged)
         self._ui.modeFive_doubleSpinBox.valueChanged.connect(self._modeFiveChanged)
         self._ui.modeSix_doubleSpinBox.valueChanged.connect(self._modeSixeChanged)
+        """ Morphing """
+        self._morphTimer.timeout.connect(self._applyMorphing)
+        self._morphScheduler.morphReady.connect(self._morphReady)
 
     def _doneClicked(self):
+        self._stopMorphing()
         self._doneCallback()
 
+    def showEvent(self, event):
+        self._morphScheduler.start()
+        super(LungModelWidget, self).showEvent(event)
+
+    def closeEvent(self, event):
+        self._stopMorphing()
+        super(LungModelWidget, self).closeEvent(event)
+
+    def _stopMorphing(self):
+        self._morphTimer.stop()
+        self._morphScheduler.stop()
+
     def _initialUiState(self):
         self._ui.leftlungUpper_checkBox.setChecked(True)
         self._ui.leftlungLower_checkBox.setChecked(True)
@@ -115,15 +137,14 @@ class LungModelWidget(QtGui.QWidget):
     def _getAverageLung(self):
         return self._pcaModel.averageLung()
 
-    def _getMorphedLung(self):
-        weights = [self._modeDict['modeOne'],
-                   self._modeDict['modeTwo'],
-                   self._modeDict['modeThree'],
-                   self._modeDict['modeFour'],
-                   self._modeDict['modeFive'],
-                   self._modeDict['modeSix']
-                   ]
-        return self._pcaModel.morph(weights)
+    def _getModeWeights(self):
+        return [self._modeDict['modeOne'],
+                self._modeDict['modeTwo'],
+                self._modeDict['modeThree'],
+                self._modeDict['modeFour'],
+                self._modeDict['modeFive'],
+                self._modeDict['modeSix']
+                ]
 
     def _modeOneChanged(self, value):
         self._changeMode('modeOne', value)
@@ -145,7 +166,7 @@ class LungModelWidget(QtGui.QWidget):
 
     def _changeMode(self, mode, value):
         self._modeDict[mode] = value
-        self._applyMorphing()
+        self._morphTimer.start()
 
     def _resetSpinBoxValues(self):
         self._ui.modeOne_doubleSpinBox.setValue(0.0)
@@ -157,7 +178,10 @@ class LungModelWidget(QtGui.QWidget):
         return
 
     def _applyMorphing(self):
-        leftNodes, rightNodes = self._getMorphedLung()
+        self._morphTimer.stop()
+        self._morphScheduler.requestMorph(self._getModeWeights())
+
+    def _morphReady(self, leftNodes, rightNodes):
         self._meshModel.applyMorphing(leftNodes, lung='left')
         self._meshModel.applyMorphing(rightNodes, lung='right')
 
@@ -0,0 +1,79 @@
+from PySide import QtCore
+
+
+class MorphScheduler(QtCore.QThread):
+    """
+    Computes lung morphs on a worker thread.
+
+    Only the latest requested mode vector is kept: requests superseded
+    before the worker picks them up are dropped, and a finished morph is
+    only emitted when no newer request arrived while it was computed.
+    The morphReady signal is delivered on the thread the scheduler was
+    created in, i.e. the GUI thread.
+
+    The thread is stopped when its parent is destroyed or the application
+    quits, as Qt aborts when a running QThread is destroyed.
+    """
+
+    morphReady = QtCore.Signal(object, object)
+
+    def __init__(self, pcaModel, parent=None):
+        super(MorphScheduler, self).__init__(parent)
+        self._pcaModel = pcaModel
+        self._morphSession = pcaModel.createMorphSession()
+        self._mutex = QtCore.QMutex()
+        self._condition = QtCore.QWaitCondition()
+        self._pendingWeights = None
+        self._stopping = False
+        if parent is not None:
+            parent.destroyed.connect(self.stop)
+        app = QtCore.QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop)
+
+    def start(self):
+        self._mutex.lock()
+        try:
+            self._stopping = False
+        finally:
+            self._mutex.unlock()
+        super(MorphScheduler, self).start()
+
+    def requestMorph(self, weights):
+        self._mutex.lock()
+        try:
+            self._pendingWeights = list(weights)
+            self._condition.wakeOne()
+        finally:
+            self._mutex.unlock()
+
+    def stop(self):
+        self._mutex.lock()
+        try:
+            self._stopping = True
+            self._condition.wakeOne()
+        finally:
+            self._mutex.unlock()
+        self.wait()
+
+    def run(self):
+        while True:
+            self._mutex.lock()
+            try:
+                while self._pendingWeights is None and not self._stopping:
+                    self._condition.wait(self._mutex)
+                if self._stopping:
+                    return
+                weights, self._pendingWeights = self._pendingWeights, None
+            finally:
+                self._mutex.unlock()
+
+            leftNodes, rightNodes = self._pcaModel.getLungNodes(self._morphSession.setWeights(weights))
+
+            self._mutex.lock()
+            try:
+                superseded = self._pendingWeights is not None
+            finally:
+                self._mutex.unlock()
+            if not superseded:
+                self.morphReady.emit(leftNodes, rightNodes)